@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks for db4sphinx
+    ========================
+    ``python -m benchmarks.run`` measures parsing, conversion and Sphinx
+    builds on the synthetic corpora of benchmarks.corpus, and
+    ``python benchmarks/startup.py`` checks the startup time of the
+    command line tools and of the Sphinx extension.
+    ``python -m benchmarks.parallel`` checks that serial and parallel
+    Sphinx builds of an assembly give the same HTML, and
+    ``python -m benchmarks.assembly_info`` times purging and merging
+    the structure of an assembly with 50000 modules.
+    ``python benchmarks/dispatch.py`` times the lookup of the method
+    that converts each element.
+    ``python -m benchmarks.input_memory`` compares the peak memory of
+    converting a large file given as a memory map, as bytes or as a
+    string.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Purging and merging the structure of large assemblies
+    =====================================================
+    Fill the DocbookAssemblyInfo of a Sphinx environment as an assembly
+    with `chapters` modules of `sections` modules each would, without
+    running Sphinx, and time the operations done on it by incremental
+    and parallel builds:
+
+    ``merge``
+        merging the assembly, as read by a parallel reader, into an
+        empty environment
+    ``purge reread``
+        purging topics that are read again
+    ``purge removed``
+        purging topics that were deleted
+    ``purge assembly``
+        purging the assembly itself
+    ``old scan``
+        for comparison, purging the removed topics with the full scan of
+        the children of every module that purge used to do
+
+    Each size is run with half and with a quarter of the chapters too.
+    From one line to the next, the times should double, while those of
+    the old scan grow four times.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+OPERATIONS = ('merge', 'purge reread', 'purge removed', 'purge assembly',
+              'old scan')
+
+class _Env(object):
+    "the part of a Sphinx environment that DocbookAssemblyInfo uses"
+
+    def __init__(self, found_docs):
+        self.found_docs = found_docs
+
+def fill(info, chapters, sections, assembly='index'):
+    """
+    Record in info the structure that reading the assembly would, and
+    return the names of the topics.
+    """
+    top = 'top'
+    topics = [top]
+    info.add_assembly(assembly, top)
+    info.add_placeholder(assembly, top)
+    for i in range(chapters):
+        chapter = 'c%d' % i
+        topics.append(chapter)
+        info.add_child(assembly, top, chapter, 'Chapter %d' % i)
+        info.add_placeholder(assembly, chapter)
+        for j in range(sections):
+            section = 'c%d_s%d' % (i, j)
+            topics.append(section)
+            info.add_child(assembly, chapter, section, 'Section %d' % j)
+    return topics
+
+def _scan_purge(children, docname):
+    for key in children.keys():
+        children[key] = [x for x in children[key] if x[1] != docname]
+
+def measure(chapters, sections, purged):
+    "return the seconds taken by each of OPERATIONS"
+    from ext import DocbookAssemblyInfo
+
+    times = {}
+    other = DocbookAssemblyInfo()
+    topics = fill(other, chapters, sections)
+    info = DocbookAssemblyInfo()
+    start = _clock()
+    info.merge(other, ['index'])
+    times['merge'] = _clock() - start
+
+    step = max(1, len(topics) // purged)
+    found_docs = set(topics) | set(['index'])
+    env = _Env(found_docs)
+    start = _clock()
+    for docname in topics[1::step]:
+        info.purge(env, docname)
+    times['purge reread'] = _clock() - start
+
+    removed = topics[2::step]
+    children = dict((key, list(value)) for key, value in info.children.items())
+    start = _clock()
+    for docname in removed:
+        _scan_purge(children, docname)
+    times['old scan'] = _clock() - start
+
+    found_docs.difference_update(removed)
+    start = _clock()
+    for docname in removed:
+        info.purge(env, docname)
+    times['purge removed'] = _clock() - start
+
+    start = _clock()
+    info.purge(env, 'index')
+    times['purge assembly'] = _clock() - start
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times purging and merging the structure of a large '
+                    'assembly in the Sphinx environment.')
+    parser.add_argument('--chapters', type=int, default=500,
+                        help='modules below the structure (default: 500)')
+    parser.add_argument('--sections', type=int, default=100,
+                        help='modules below each chapter (default: 100)')
+    parser.add_argument('--purged', type=int, default=500,
+                        help='topics that are reread, and topics that are '
+                             'removed (default: 500)')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(ROOT, 'db4sphinx'))
+    print('%8s %8s' % ('modules', 'purged')
+          + ''.join(' %14s' % name for name in OPERATIONS))
+    for divisor in (4, 2, 1):
+        chapters = max(1, args.chapters // divisor)
+        purged = max(1, args.purged // divisor)
+        times = measure(chapters, args.sections, purged)
+        print('%8d %8d' % (chapters * (args.sections + 1), purged)
+              + ''.join(' %12.1f ms' % (times[name] * 1000)
+                        for name in OPERATIONS))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+    Synthetic DocBook corpora
+    =========================
+    Each generator returns a dictionary that maps file names to the XML
+    text of the files.  The text is pseudo-random but deterministic, so
+    the same parameters always give the same corpus and timings can be
+    compared across commits.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import os
+import random
+
+DB5_NS = 'http://docbook.org/ns/docbook'
+
+_WORDS = ('the', 'of', 'a', 'buffer', 'device', 'returns', 'is', 'value',
+          'queue', 'when', 'lock', 'for', 'page', 'memory', 'to', 'request',
+          'driver', 'and', 'called', 'with', 'state', 'in', 'not', 'table',
+          'interrupt', 'that', 'file', 'may', 'be', 'each', 'entry', 'block')
+
+class _Text(object):
+    "pseudo-random text with DocBook inline markup"
+
+    def __init__(self, version, seed):
+        self.version = version
+        self.random = random.Random(seed)
+        self.ids = []
+
+    def id_attr(self, xml_id):
+        return '%s="%s"' % ('xml:id' if self.version == 5 else 'id', xml_id)
+
+    def root_attrs(self):
+        if self.version == 5:
+            return (' xmlns="%s" xmlns:xlink="http://www.w3.org/1999/xlink"'
+                    ' version="5.0"' % DB5_NS)
+        return ''
+
+    def words(self, n):
+        return ' '.join(self.random.choice(_WORDS) for _ in range(n))
+
+    def title(self):
+        return self.words(self.random.randint(2, 5)).capitalize()
+
+    def inline(self):
+        r = self.random.random()
+        word = self.random.choice(_WORDS)
+        if r < 0.2:
+            return '<emphasis>%s</emphasis>' % word
+        if r < 0.35:
+            return '<literal>%s_%s</literal>' % (word, self.random.choice(_WORDS))
+        if r < 0.45:
+            return '<command>%s</command>' % word
+        if r < 0.55:
+            return '<option>--%s</option>' % word
+        if r < 0.65:
+            return '<filename>/usr/share/%s</filename>' % word
+        if r < 0.75:
+            url = 'http://example.org/%s' % word
+            if self.version == 5:
+                return '<link xlink:href="%s">%s</link>' % (url, word)
+            return '<ulink url="%s">%s</ulink>' % (url, word)
+        if r < 0.85 and self.ids:
+            return '<xref linkend="%s"/>' % self.random.choice(self.ids)
+        if r < 0.9:
+            return '<quote>%s</quote>' % word
+        return '<footnote><para>%s.</para></footnote>' % self.words(6)
+
+    def para(self, sentences=3):
+        parts = []
+        for _ in range(sentences):
+            parts.append(self.words(self.random.randint(5, 12)))
+            parts.append(self.inline())
+        return '<para>%s.</para>' % ' '.join(parts)
+
+def _header(text, tag, xml_id):
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<%s %s%s>\n'
+            % (tag, text.id_attr(xml_id), text.root_attrs()))
+
+def deep_book(version=5, chapters=4, depth=4, sections=2, paragraphs=3,
+              seed=1):
+    """
+    A book whose chapters have `sections` subsections on each of
+    `depth` levels, each with `paragraphs` paragraphs.  DocBook 4 books
+    use sect1...sect3 if they are not deeper than that, and section
+    otherwise.
+    """
+    text = _Text(version, seed)
+    text.ids = ['ch%d' % (i + 1) for i in range(chapters)]
+    out = [_header(text, 'book', 'book'), '<title>Deep book</title>\n']
+    counter = [0]
+
+    def section(level):
+        counter[0] += 1
+        tag = 'sect%d' % level if version == 4 and depth <= 3 else 'section'
+        out.append('<%s %s><title>%s</title>\n'
+                   % (tag, text.id_attr('s%d' % counter[0]), text.title()))
+        for _ in range(paragraphs):
+            out.append(text.para() + '\n')
+        if level < depth:
+            for _ in range(sections):
+                section(level + 1)
+        out.append('</%s>\n' % tag)
+
+    for i in range(chapters):
+        out.append('<chapter %s><title>%s</title>\n'
+                   % (text.id_attr('ch%d' % (i + 1)), text.title()))
+        out.append(text.para() + '\n')
+        for _ in range(sections):
+            section(1)
+        out.append('</chapter>\n')
+    out.append('</book>\n')
+    return {'index.xml': ''.join(out)}
+
+def long_lists(version=5, lists=10, items=200, seed=2):
+    "an article with long itemized, ordered and variable lists"
+    text = _Text(version, seed)
+    out = [_header(text, 'article', 'lists'), '<title>Long lists</title>\n']
+    for i in range(lists):
+        kind = ('itemizedlist', 'orderedlist', 'variablelist')[i % 3]
+        out.append('<%s>\n' % kind)
+        for _ in range(items):
+            if kind == 'variablelist':
+                out.append('<varlistentry><term>%s</term><listitem>%s'
+                           '</listitem></varlistentry>\n'
+                           % (text.inline(), text.para(1)))
+            else:
+                out.append('<listitem>%s</listitem>\n' % text.para(1))
+        out.append('</%s>\n' % kind)
+    out.append('</article>\n')
+    return {'index.xml': ''.join(out)}
+
+def makeinfo_list(items=20000, seed=7):
+    """
+    A makeinfo manual with one long itemized list.  makeinfo writes the
+    bullet at the start of each item, and the converter strips it.
+    """
+    text = _Text(4, seed)
+    out = [_header(text, 'book', 'Top'), '<title>Long list</title>\n',
+           '<chapter id="list"><title>List</title>\n<itemizedlist>\n']
+    for i in range(items):
+        out.append('<listitem><para>&#8226; item %d %s</para></listitem>\n'
+                   % (i, text.words(4)))
+    out.append('</itemizedlist>\n</chapter>\n</book>\n')
+    return {'index.xml': ''.join(out)}
+
+def kerneldoc(functions=100, parameters=4, seed=3):
+    """
+    A book of reference entries like those written by the Linux
+    kernel-doc script, with a function prototype and a description of
+    the parameters for each function.  kernel-doc writes DocBook 4.
+    """
+    text = _Text(4, seed)
+    rnd = text.random
+    out = [_header(text, 'book', 'api'), '<title>API reference</title>\n',
+           '<chapter id="functions"><title>Functions</title>\n']
+    for i in range(functions):
+        name = '%s_%s_%d' % (rnd.choice(_WORDS), rnd.choice(_WORDS), i)
+        params = ['%s_%d' % (rnd.choice(_WORDS), j) for j in range(parameters)]
+        out.append('<refentry id="API-%s">\n'
+                   '<refentryinfo><title>LINUX</title><productname>Kernel '
+                   'Hackers Manual</productname></refentryinfo>\n'
+                   '<refmeta><refentrytitle><phrase>%s</phrase>'
+                   '</refentrytitle><manvolnum>9</manvolnum></refmeta>\n'
+                   '<refnamediv><refname>%s</refname><refpurpose>%s'
+                   '</refpurpose></refnamediv>\n'
+                   '<refsynopsisdiv><title>Synopsis</title><funcsynopsis>'
+                   '<funcprototype><funcdef>int <function>%s</function>'
+                   '</funcdef>\n' % (name, name, name, text.words(6), name))
+        for j, param in enumerate(params):
+            if j == parameters - 1:
+                out.append('<paramdef>void (*<parameter>%s</parameter>)'
+                           '<funcparams>struct %s *</funcparams></paramdef>\n'
+                           % (param, rnd.choice(_WORDS)))
+            else:
+                out.append('<paramdef>struct %s * <parameter>%s</parameter>'
+                           '</paramdef>\n' % (rnd.choice(_WORDS), param))
+        out.append('</funcprototype></funcsynopsis></refsynopsisdiv>\n'
+                   '<refsect1><title>Arguments</title><variablelist>\n')
+        for param in params:
+            out.append('<varlistentry><term><parameter>%s</parameter></term>'
+                       '<listitem><para>%s</para></listitem></varlistentry>\n'
+                       % (param, text.words(10)))
+        out.append('</variablelist></refsect1>\n'
+                   '<refsect1><title>Description</title>%s%s</refsect1>\n'
+                   '</refentry>\n' % (text.para(), text.para()))
+    out.append('</chapter>\n</book>\n')
+    return {'index.xml': ''.join(out)}
+
+def makeinfo(chapters=10, nodes=10, seed=4):
+    """
+    A manual like those written by makeinfo --docbook: DocBook 4, with
+    labels on the sectioning elements, index terms, screens and lots of
+    cross references.
+    """
+    text = _Text(4, seed)
+    rnd = text.random
+    text.ids = ['node-%d-%d' % (i, j) for i in range(chapters)
+                for j in range(nodes)]
+    out = [_header(text, 'book', 'Top'),
+           '<title>Synthetic manual</title>\n']
+    for i in range(chapters):
+        out.append('<chapter label="%d" id="chapter-%d"><title>%s</title>\n'
+                   % (i + 1, i, text.title()))
+        out.append(text.para() + '\n')
+        for j in range(nodes):
+            out.append('<sect1 label="%d.%d" id="node-%d-%d"><title>%s</title>\n'
+                       % (i + 1, j + 1, i, j, text.title()))
+            out.append('<indexterm role="cp"><primary>%s</primary>'
+                       '</indexterm>\n' % rnd.choice(_WORDS))
+            out.append(text.para() + '\n')
+            out.append('<screen>$ %s --%s %s\n%s\n</screen>\n'
+                       % (rnd.choice(_WORDS), rnd.choice(_WORDS),
+                          rnd.choice(_WORDS), text.words(8)))
+            out.append('<variablelist><varlistentry><term><option>-%s'
+                       '</option></term><listitem>%s</listitem>'
+                       '</varlistentry></variablelist>\n'
+                       % (rnd.choice(_WORDS)[0], text.para(1)))
+            out.append('<para>See <xref linkend="%s"></xref>.</para>\n'
+                       % rnd.choice(text.ids))
+            out.append('</sect1>\n')
+        out.append('</chapter>\n')
+    out.append('</book>\n')
+    return {'index.xml': ''.join(out)}
+
+def long_text(version=4, entries=20, words=10000, seed=6):
+    """
+    Index entries and reference entry names of `words` words each, with
+    some inline markup, whose text is extracted without the markup.
+    """
+    text = _Text(version, seed)
+    rnd = text.random
+
+    def run(xml_id):
+        parts = []
+        for i in range(0, words, 8):
+            parts.append(text.words(min(8, words - i)))
+            parts.append('<emphasis %s>%s</emphasis>'
+                         % (text.id_attr('%s_%d' % (xml_id, i)),
+                            rnd.choice(_WORDS)))
+        return ' '.join(parts)
+
+    out = [_header(text, 'book', 'long'), '<title>Long text</title>\n',
+           '<chapter %s><title>Index</title>\n' % text.id_attr('index')]
+    for i in range(entries):
+        out.append('<para>%s<indexterm><primary>%s</primary><secondary>%s'
+                   '</secondary></indexterm></para>\n'
+                   % (text.words(5), run('p%d' % i), text.words(3)))
+    out.append('</chapter>\n')
+    for i in range(entries):
+        out.append('<refentry %s><refnamediv><refname>%s</refname>'
+                   '<refpurpose>%s</refpurpose></refnamediv>'
+                   '<refsynopsisdiv><title>Synopsis</title><funcsynopsis>'
+                   '<funcprototype><funcdef>int <function>long_%d</function>'
+                   '</funcdef><paramdef>void</paramdef></funcprototype>'
+                   '</funcsynopsis></refsynopsisdiv>'
+                   '<refsect1><title>Description</title>%s</refsect1>'
+                   '</refentry>\n'
+                   % (text.id_attr('ref%d' % i), run('r%d' % i),
+                      text.words(6), i, text.para()))
+    out.append('</book>\n')
+    return {'index.xml': ''.join(out)}
+
+def assembly(structures=2, modules=10, submodules=2, paragraphs=4, seed=5):
+    """
+    A DocBook 5 assembly with `structures` structures, each with
+    `modules` modules that have `submodules` children; every module is
+    a separate topic file.
+    """
+    text = _Text(5, seed)
+    files = {}
+    resources = []
+    structure = []
+
+    def topic(xml_id):
+        title = text.title()
+        body = ''.join(text.para() + '\n' for _ in range(paragraphs))
+        files['topics/%s.xml' % xml_id] = (
+            _header(text, 'section', xml_id) +
+            '<title>%s</title>\n%s</section>\n' % (title, body))
+        resources.append('<resource xml:id="%s" fileref="%s.xml">'
+                         '<description>%s</description></resource>\n'
+                         % (xml_id, xml_id, title))
+
+    for i in range(structures):
+        top = 'top%d' % i
+        topic(top)
+        structure.append('<structure resourceref="%s">\n' % top)
+        for j in range(modules):
+            module = 'm%d_%d' % (i, j)
+            topic(module)
+            structure.append('<module resourceref="%s">\n' % module)
+            for k in range(submodules):
+                child = 'm%d_%d_%d' % (i, j, k)
+                topic(child)
+                structure.append('<module resourceref="%s"/>\n' % child)
+            structure.append('</module>\n')
+        structure.append('</structure>\n')
+
+    files['index.xml'] = (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<assembly xmlns="%s" version="5.1">\n'
+        '<resources xml:base="topics/">\n%s</resources>\n%s</assembly>\n'
+        % (DB5_NS, ''.join(resources), ''.join(structure)))
+    return files
+
+# name, generator, parameters; the sizes are multiplied by the scale
+CASES = (
+    ('db4-sect', deep_book, {'version': 4, 'chapters': 4, 'depth': 3,
+                             'sections': 3}),
+    ('db5-deep', deep_book, {'version': 5, 'chapters': 4, 'depth': 6}),
+    ('db4-lists', long_lists, {'version': 4, 'lists': 6}),
+    ('db5-lists', long_lists, {'version': 5, 'lists': 6}),
+    ('kerneldoc', kerneldoc, {'functions': 100}),
+    ('makeinfo', makeinfo, {'chapters': 8}),
+    ('makeinfo-list', makeinfo_list, {'items': 20000}),
+    ('assembly', assembly, {'structures': 2, 'modules': 10}),
+    ('long-text', long_text, {'entries': 20}),
+)
+
+# the parameters that grow with the scale
+_SCALED = ('chapters', 'lists', 'functions', 'structures', 'entries',
+           'items')
+
+def generate(directory, name, generator, parameters, scale=1.0):
+    """
+    Write the corpus for one case into `directory`, and return the list
+    of the files that were written.
+    """
+    parameters = dict(parameters)
+    for key in _SCALED:
+        if key in parameters:
+            parameters[key] = max(1, int(round(parameters[key] * scale)))
+    written = []
+    for filename, content in sorted(generator(**parameters).items()):
+        path = os.path.join(directory, *filename.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(content.encode('utf-8'))
+        written.append(path)
+    return written
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Cost of dispatching elements to their e_tag() methods
+    =====================================================
+    Find the method for every element of a generated book, without
+    calling it, and print the time per element:
+
+    ``table``
+        the dispatch table of DocbookConverter, with _lookup for the
+        elements that are not in it
+    ``getattr``
+        for comparison, stripping the namespace from the tag and looking
+        for the method with hasattr and getattr, as _conv used to do
+
+    The book has chapters of paragraphs full of inline markup, and is
+    generated both as DocBook 4 and as DocBook 5.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PARA = ('<para>The <command>ls</command> command lists '
+         '<filename>/etc</filename>; see <xref linkend="c0"/> and '
+         '<ulink url="http://example.org">the <emphasis>manual</emphasis>'
+         '</ulink> for <literal>-l</literal> and <option>-a</option>.'
+         '</para>\n')
+
+def book(version, chapters, paragraphs):
+    "the text of a book with `chapters` chapters of `paragraphs` paragraphs"
+    if version == 5:
+        out = ['<book xmlns="http://docbook.org/ns/docbook" version="5.0">\n']
+        chapter = '<chapter xml:id="c%d"><title>Chapter %d</title>\n'
+    else:
+        out = ['<book>\n']
+        chapter = '<chapter id="c%d"><title>Chapter %d</title>\n'
+    out.append('<title>Dispatch</title>\n')
+    for i in range(chapters):
+        out.append(chapter % (i, i))
+        out.extend([_PARA] * paragraphs)
+        out.append('</chapter>\n')
+    out.append('</book>\n')
+    return ''.join(out)
+
+def _converter(root):
+    import warnings
+    from docutils.frontend import OptionParser
+    from docutils.utils import new_document
+    from db4sphinx.dbparser import DocbookParser
+
+    parser = DocbookParser()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        settings = OptionParser(components=(parser,)).get_default_values()
+    document = new_document('<dispatch>', settings)
+    return parser._get_converter(document, root)
+
+def table(converter, elements):
+    dispatch = converter._dispatch
+    for el in elements:
+        try:
+            dispatch[el.tag]
+        except KeyError:
+            converter._lookup(el)
+
+def getattr_lookup(converter, elements):
+    ns = converter._ns
+    for el in elements:
+        tag = str(el.tag)
+        method_name = None
+        if tag.find(ns) == 0:
+            tag = tag[len(ns):]
+            method_name = 'e_' + tag
+        elif tag.startswith('{'):
+            uri, raw_tag = tag[1:].split('}')
+            prefix = converter._NSMAP.get(uri, None)
+            if prefix is not None:
+                method_name = 'e_%s_%s' % (prefix, raw_tag)
+        if method_name is not None and hasattr(converter, method_name):
+            getattr(converter, method_name)
+
+def measure(function, converter, elements, runs):
+    "best time per element of `runs` calls of function, in seconds"
+    best = None
+    for _ in range(runs):
+        start = _clock()
+        function(converter, elements)
+        elapsed = _clock() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(elements)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times the lookup of the e_tag() method for each '
+                    'element of a document.')
+    parser.add_argument('--chapters', type=int, default=100,
+                        help='chapters in the book (default: 100)')
+    parser.add_argument('--paragraphs', type=int, default=100,
+                        help='paragraphs in each chapter (default: 100)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='runs of each lookup; the best one counts '
+                             '(default: 5)')
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    import lxml.etree
+
+    print('%-8s %9s %11s %11s' % ('book', 'elements', 'table', 'getattr'))
+    for version in (4, 5):
+        text = book(version, args.chapters, args.paragraphs)
+        root = lxml.etree.fromstring(text.encode('utf-8'))
+        elements = list(root.iter())
+        converter = _converter(root)
+        times = [measure(function, converter, elements, args.repeat)
+                 for function in (table, getattr_lookup)]
+        print('%-8s %9d %8.3f us %8.3f us'
+              % (('DocBook %d' % version, len(elements))
+                 + tuple(t * 1e6 for t in times)))
+
+if __name__ == '__main__':
+    main()
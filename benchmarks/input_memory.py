@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Peak memory of the ways to give a document to DocbookParser
+    ===========================================================
+    Generate one large document, made mostly of text, and measure in a
+    new interpreter how much parsing it with lxml, and converting it to
+    a doctree, raise the peak RSS when the input is:
+
+    ``mmap``
+        the memory-mapped file, as DocbookFileInput reads it for the
+        command line tools
+    ``bytes``
+        the contents of the file, as read from stdin or given to the
+        conversion server
+    ``str``
+        the contents decoded by docutils, as Sphinx gives them after
+        its source-read event
+
+    Each paragraph has a dash, as typeset text often does; since it is
+    not in Latin-1, Python stores the decoded text with two bytes per
+    character.  --ascii leaves the dashes out.
+
+    The pages of the memory map count in the RSS as they are read, so
+    ``mmap`` and ``bytes`` usually have the same peak; the difference is
+    that the kernel can drop the pages of the map, and reread them from
+    the file, when memory is short.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+try:
+    from benchmarks.run import ROOT, _maxrss_kb
+except ImportError:
+    from run import ROOT, _maxrss_kb
+
+INPUTS = ('mmap', 'bytes', 'str')
+STEPS = ('parse', 'convert')
+
+_WORDS = ('the', 'memory', 'page', 'driver', 'lock', 'queue', 'state', 'of',
+          'table', 'file', 'is', 'a', 'request', 'block', 'and', 'entry')
+
+def write_book(path, chapters, ascii_only=False):
+    "write a book of `chapters` chapters with 100 paragraphs of 1600 words"
+    import random
+    rnd = random.Random(1)
+    dash = u' ' if ascii_only else u' \u2014 '
+    with open(path, 'wb') as f:
+        f.write(b'<?xml version="1.0" encoding="utf-8"?>\n'
+                b'<book><title>Input memory</title>\n')
+        for i in range(chapters):
+            f.write(('<chapter><title>Chapter %d</title>\n' % i).encode())
+            for _ in range(100):
+                words = [rnd.choice(_WORDS) for _ in range(1600)]
+                para = u'<para>%s%s%s.</para>\n' % (
+                    ' '.join(words[:800]), dash, ' '.join(words[800:]))
+                f.write(para.encode('utf-8'))
+            f.write(b'</chapter>\n')
+        f.write(b'</book>\n')
+
+# parts that run in the child process
+
+def _read(input_kind, path):
+    import docutils.io
+    from db4sphinx.dbparser import DocbookFileInput
+    if input_kind == 'mmap':
+        return DocbookFileInput(source_path=path).read()
+    elif input_kind == 'bytes':
+        with open(path, 'rb') as f:
+            return f.read()
+    else:
+        return docutils.io.FileInput(source_path=path,
+                                     encoding='utf-8').read()
+
+def _child(input_kind, step, path):
+    "print how much reading and processing the file raised the peak RSS"
+    import io
+    import warnings
+    from docutils.core import publish_doctree
+    from docutils.frontend import OptionParser
+    from docutils.utils import new_document
+    from db4sphinx.dbparser import (DocbookParser, DocbookFileInput,
+                                    DocbookStringInput)
+
+    parser = DocbookParser()
+    overrides = {'warning_stream': io.StringIO(), 'report_level': 5}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        settings = OptionParser(components=(parser,),
+                                defaults=overrides).get_default_values()
+
+    rss_before = _maxrss_kb()
+    if step == 'parse':
+        parser._parse_xml(_read(input_kind, path),
+                          new_document(path, settings))
+    elif input_kind == 'mmap':
+        publish_doctree(None, source_path=path,
+                        source_class=DocbookFileInput, parser=parser,
+                        settings_overrides=overrides)
+    else:
+        publish_doctree(_read(input_kind, path), source_path=path,
+                        source_class=DocbookStringInput, parser=parser,
+                        settings_overrides=overrides)
+    print(json.dumps({'rss_delta_kb': _maxrss_kb() - rss_before}))
+
+# parts that run in the parent process
+
+def _run_child(python, input_kind, step, path):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    process = subprocess.Popen([python, '-m', 'benchmarks.input_memory',
+                                '--child', input_kind, step, path],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               env=env, cwd=ROOT)
+    out, err = process.communicate()
+    if process.returncode:
+        lines = err.decode('utf-8', 'replace').strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else
+                           'exit status %d' % process.returncode)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == '--child':
+        _child(sys.argv[2], sys.argv[3], sys.argv[4])
+        return
+
+    parser = argparse.ArgumentParser(
+        description='Measures the peak memory of parsing and converting a '
+                    'large DocBook file given as a memory map, as bytes '
+                    'or as a string.')
+    parser.add_argument('--chapters', type=int, default=50,
+                        help='size of the document, about 0.8 MB per '
+                             'chapter (default: 50)')
+    parser.add_argument('--ascii', action='store_true',
+                        help='do not put dashes in the text')
+    parser.add_argument('--steps', default=','.join(STEPS),
+                        help='comma-separated steps to run '
+                             '(default: %(default)s)')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter for the measurements')
+    args = parser.parse_args()
+
+    steps = [s for s in args.steps.split(',') if s]
+    for step in steps:
+        if step not in STEPS:
+            parser.error('unknown step %r' % step)
+
+    directory = tempfile.mkdtemp(prefix='db4sphinx-input-')
+    try:
+        path = os.path.join(directory, 'book.xml')
+        write_book(path, args.chapters, args.ascii)
+        print('%s: %.1f MB' % (os.path.basename(path),
+                               os.path.getsize(path) / 1048576.0))
+        print('%-8s' % 'input' + ''.join(' %13s' % s for s in steps))
+        for input_kind in INPUTS:
+            line = '%-8s' % input_kind
+            for step in steps:
+                try:
+                    result = _run_child(args.python, input_kind, step, path)
+                except RuntimeError as e:
+                    parser.exit(2, '%s: %s %s failed: %s\n'
+                                % (parser.prog, input_kind, step, e))
+                line += ' %10.1f MB' % (result['rss_delta_kb'] / 1024.0)
+            print(line)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Serial and parallel Sphinx builds of an assembly
+    ================================================
+    Build the assembly corpus of benchmarks.corpus with one process and
+    with several, and check that the HTML pages are the same.  The exit
+    status is 1 if some page differs or is missing from one of the
+    builds.
+
+    The assembly placeholders must be expanded in the main process, so
+    this catches changes that would make parallel_write_safe wrong.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+try:
+    from benchmarks import corpus
+    from benchmarks.run import ROOT, _CONF_PY
+except ImportError:
+    import corpus
+    from run import ROOT, _CONF_PY
+
+def build(python, directory, jobs):
+    "build the HTML for the project in directory, return the output directory"
+    output = os.path.join(directory, '_build', 'j%d' % jobs)
+    process = subprocess.Popen([python, '-m', 'sphinx', '-q', '-b', 'html',
+                                '-j', str(jobs), '-d', output + '.doctrees',
+                                directory, output],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = process.communicate()
+    if process.returncode:
+        lines = err.decode('utf-8', 'replace').strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else
+                           'exit status %d' % process.returncode)
+    return output
+
+def html_pages(output):
+    "the HTML pages in output, as a dictionary from relative paths to bytes"
+    pages = {}
+    for dirpath, dirnames, filenames in os.walk(output):
+        for filename in filenames:
+            if filename.endswith('.html'):
+                path = os.path.join(dirpath, filename)
+                with open(path, 'rb') as f:
+                    pages[os.path.relpath(path, output)] = f.read()
+    return pages
+
+def compare(serial, parallel):
+    "return the pages that differ between two dictionaries from html_pages"
+    return sorted(name for name in set(serial) | set(parallel)
+                  if serial.get(name) != parallel.get(name))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Checks that serial and parallel Sphinx builds of an '
+                    'assembly give the same HTML.')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='processes for the parallel build (default: 4)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the size of the assembly')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter that runs Sphinx')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temporary directory')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='db4sphinx-parallel-')
+    try:
+        for name, generator, parameters in corpus.CASES:
+            if name == 'assembly':
+                corpus.generate(directory, name, generator, parameters,
+                                args.scale)
+        with open(os.path.join(directory, 'conf.py'), 'w') as f:
+            f.write(_CONF_PY % os.path.join(ROOT, 'db4sphinx'))
+        try:
+            serial = html_pages(build(args.python, directory, 1))
+            parallel = html_pages(build(args.python, directory, args.jobs))
+        except (RuntimeError, EnvironmentError) as e:
+            parser.exit(2, '%s: build failed: %s\n' % (parser.prog, e))
+        different = compare(serial, parallel)
+    finally:
+        if args.keep:
+            print('builds kept in %s' % directory)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    for name in different:
+        print('%s: differs between -j1 and -j%d' % (name, args.jobs))
+    print('%d pages, %d different' % (len(serial), len(different)))
+    sys.exit(1 if different or not serial else 0)
+
+if __name__ == '__main__':
+    main()
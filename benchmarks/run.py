@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Benchmark suite
+    ===============
+    Generates the synthetic corpora from benchmarks.corpus and measures,
+    for each of them:
+
+    ``xml_parse``
+        parsing the XML files with lxml
+    ``convert``
+        converting the documents to docutils doctrees with DocbookParser
+        (this includes parsing them); with ``--input file`` lxml reads
+        them through DocbookFileInput, like the command line tools do,
+        and with ``--input string`` docutils decodes them to a string
+        first
+    ``sphinx_read`` and ``sphinx_write``
+        the read and write phases of a fresh Sphinx HTML build
+
+    Each step runs in a new interpreter, which reports the elapsed time
+    and its peak resident set size.  The results are written as JSON;
+    --compare prints the ratios against an earlier results file, e.g.
+    one written by another commit.
+
+        python -m benchmarks.run -o new.json --compare old.json
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from benchmarks import corpus
+except ImportError:
+    import corpus
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STEPS = ('xml_parse', 'convert', 'sphinx')
+
+_CONF_PY = '''import sys
+sys.path.insert(0, %r)
+extensions = ['ext']
+source_suffix = ['.xml']
+master_doc = 'index'
+exclude_patterns = ['_build']
+'''
+
+# parts that run in the child process
+
+def _maxrss_kb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def _documents(directory):
+    "the XML files in directory, except assemblies and the Sphinx output"
+    import lxml.etree
+    result = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames[:] = sorted(d for d in dirnames if d != '_build')
+        for filename in sorted(filenames):
+            if filename.endswith('.xml'):
+                path = os.path.join(dirpath, filename)
+                for _, el in lxml.etree.iterparse(path, events=('start',)):
+                    if not el.tag.endswith('}assembly'):
+                        result.append(path)
+                    break
+    return result
+
+def _xml_parse(directory):
+    import lxml.etree
+    files = _documents(directory)
+    start = time.time()
+    for path in files:
+        lxml.etree.parse(path)
+    return {'xml_parse': time.time() - start}
+
+def _convert(directory, input_kind):
+    import io
+    from docutils.core import publish_doctree
+    from db4sphinx.dbparser import DocbookParser, DocbookFileInput
+    files = _documents(directory)
+    start = time.time()
+    for path in files:
+        settings = {'warning_stream': io.StringIO(), 'report_level': 5}
+        if input_kind == 'file':
+            publish_doctree(None, source_path=path,
+                            source_class=DocbookFileInput,
+                            parser=DocbookParser(), settings_overrides=settings)
+        else:
+            with open(path, 'rb') as f:
+                publish_doctree(f.read(), source_path=path,
+                                parser=DocbookParser(),
+                                settings_overrides=settings)
+    return {'convert': time.time() - start}
+
+def _sphinx(directory):
+    import io
+    from sphinx.application import Sphinx
+    build = os.path.join(directory, '_build')
+    shutil.rmtree(build, ignore_errors=True)
+    times = {}
+    rss = {}
+
+    def read_start(app, env, docnames):
+        times.setdefault('read_start', time.time())
+
+    def read_end(app, env):
+        times['read_end'] = time.time()
+        rss['sphinx_read'] = _maxrss_kb()
+
+    warnings = io.StringIO()
+    app = Sphinx(directory, directory, os.path.join(build, 'html'),
+                 os.path.join(build, 'doctrees'), 'html',
+                 status=None, warning=warnings, freshenv=True)
+    app.connect('env-before-read-docs', read_start)
+    app.connect('env-updated', read_end)
+    app.build()
+    end = time.time()
+    return ({'sphinx_read': times['read_end'] - times['read_start'],
+             'sphinx_write': end - times['read_end']},
+            rss, len(warnings.getvalue().splitlines()))
+
+def _child(step, directory, input_kind):
+    "run one step, and print its results as JSON"
+    if step == 'versions':
+        import docutils
+        import lxml.etree
+        versions = {'python': platform.python_version(),
+                    'docutils': docutils.__version__,
+                    'lxml': '.'.join(map(str, lxml.etree.LXML_VERSION))}
+        try:
+            import sphinx
+            versions['sphinx'] = sphinx.__version__
+        except ImportError:
+            pass
+        print(json.dumps(versions))
+        return
+
+    rss_before = _maxrss_kb()
+    warnings = None
+    if step == 'sphinx':
+        seconds, rss, warnings = _sphinx(directory)
+    elif step == 'convert':
+        seconds, rss = _convert(directory, input_kind), {}
+    else:
+        seconds, rss = _xml_parse(directory), {}
+    peak = _maxrss_kb()
+    results = {}
+    for name, value in seconds.items():
+        results[name] = {'seconds': value,
+                         'peak_rss_kb': rss.get(name, peak),
+                         'rss_delta_kb': rss.get(name, peak) - rss_before}
+        if warnings is not None:
+            results[name]['warnings'] = warnings
+    print(json.dumps(results))
+
+# parts that run in the parent process
+
+def _run_child(python, step, directory='', input_kind='file'):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    process = subprocess.Popen([python, '-m', 'benchmarks.run',
+                                '--child', step, directory, input_kind],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               env=env, cwd=ROOT)
+    out, err = process.communicate()
+    if process.returncode:
+        lines = err.decode('utf-8', 'replace').strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else
+                           'exit status %d' % process.returncode)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+def _git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                      stderr=subprocess.STDOUT)
+        return out.decode('ascii').strip()
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+
+def run_case(python, directory, steps, repeat, input_kind='file'):
+    """
+    Measure the steps on the corpus in directory.  The time is the best
+    of `repeat` runs, and so is the memory.  input_kind is how the
+    convert step reads the files, 'file' or 'string'.
+    """
+    results = {}
+    for step in steps:
+        runs = []
+        try:
+            for _ in range(repeat):
+                runs.append(_run_child(python, step, directory,
+                                       input_kind))
+        except RuntimeError as e:
+            names = ('sphinx_read', 'sphinx_write') if step == 'sphinx' else (step,)
+            for name in names:
+                results[name] = {'error': str(e)}
+            continue
+        for name in runs[0]:
+            result = dict(runs[0][name])
+            result['seconds'] = min(r[name]['seconds'] for r in runs)
+            result['runs'] = [r[name]['seconds'] for r in runs]
+            for key in ('peak_rss_kb', 'rss_delta_kb'):
+                result[key] = min(r[name][key] for r in runs)
+            results[name] = result
+    return results
+
+def compare(old, new):
+    "print the time and memory of new relative to old"
+    print('%-12s %-13s %10s %10s %7s %10s %10s %7s'
+          % ('case', 'step', 'old s', 'new s', 'ratio',
+             'old MB', 'new MB', 'ratio'))
+    for case, data in sorted(new['cases'].items()):
+        old_steps = old.get('cases', {}).get(case, {}).get('steps', {})
+        for step, result in sorted(data['steps'].items()):
+            before = old_steps.get(step)
+            if 'error' in result or not before or 'error' in before:
+                continue
+            print('%-12s %-13s %10.3f %10.3f %7.2f %10.1f %10.1f %7.2f'
+                  % (case, step, before['seconds'], result['seconds'],
+                     result['seconds'] / max(before['seconds'], 1e-9),
+                     before['peak_rss_kb'] / 1024.0,
+                     result['peak_rss_kb'] / 1024.0,
+                     float(result['peak_rss_kb']) / max(before['peak_rss_kb'], 1)))
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == '--child':
+        _child(sys.argv[2], sys.argv[3], sys.argv[4])
+        return
+
+    parser = argparse.ArgumentParser(
+        description='Measures parsing, conversion and Sphinx builds on '
+                    'synthetic DocBook corpora.')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='JSON file for the results '
+                             '(default: benchmark.json)')
+    parser.add_argument('-k', '--case', action='append',
+                        choices=[name for name, _, _ in corpus.CASES],
+                        help='run only this case; can be repeated')
+    parser.add_argument('--steps', default=','.join(STEPS),
+                        help='comma-separated steps to run '
+                             '(default: %(default)s)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the size of the corpora')
+    parser.add_argument('--input', choices=('file', 'string'), default='file',
+                        help='give the convert step the files as bytes or '
+                             'memory maps, or as decoded strings '
+                             '(default: file)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs of each step; the best one counts '
+                             '(default: 3)')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter for the measurements, e.g. from '
+                             'a virtualenv with another Sphinx version')
+    parser.add_argument('--corpus-dir',
+                        help='generate the corpora here and keep them '
+                             '(default: a temporary directory)')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='compare the results with an earlier run')
+    args = parser.parse_args()
+
+    steps = [s for s in args.steps.split(',') if s]
+    for step in steps:
+        if step not in STEPS:
+            parser.error('unknown step %r' % step)
+    cases = [c for c in corpus.CASES if not args.case or c[0] in args.case]
+
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix='db4sphinx-bench-')
+    results = {'format': 1,
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'commit': _git_commit(),
+               'platform': platform.platform(),
+               'versions': _run_child(args.python, 'versions'),
+               'scale': args.scale,
+               'repeat': args.repeat,
+               'input': args.input,
+               'cases': {}}
+    try:
+        for name, generator, parameters in cases:
+            directory = os.path.join(corpus_dir, name)
+            shutil.rmtree(directory, ignore_errors=True)
+            files = corpus.generate(directory, name, generator, parameters,
+                                    args.scale)
+            with open(os.path.join(directory, 'conf.py'), 'w') as f:
+                f.write(_CONF_PY % os.path.join(ROOT, 'db4sphinx'))
+            steps_results = run_case(args.python, directory, steps,
+                                     args.repeat, args.input)
+            results['cases'][name] = {
+                'files': len(files),
+                'bytes': sum(os.path.getsize(p) for p in files),
+                'steps': steps_results}
+            for step, result in sorted(steps_results.items()):
+                if 'error' in result:
+                    print('%-12s %-13s error: %s' % (name, step, result['error']))
+                else:
+                    print('%-12s %-13s %8.3f s %8.1f MB peak'
+                          % (name, step, result['seconds'],
+                             result['peak_rss_kb'] / 1024.0))
+    finally:
+        if not args.corpus_dir:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Startup time of the db4sphinx entry points
+    ==========================================
+    Run each entry point in a fresh interpreter, subtract the time that
+    the interpreter needs to start, and compare the result with a budget.
+    The exit status is 1 if some entry point goes over its budget.
+
+    The package is copied to a temporary directory and byte-compiled
+    there first, as it would be when installed; otherwise the time to
+    compile a stale module would be measured.  The checkout is left
+    alone.
+
+    With --importtime, also show the modules that take longest to import
+    for each entry point (Python 3.7 or newer).
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import argparse
+import compileall
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CLI = ('import sys\n'
+        'from db4sphinx.%s import %s\n'
+        'sys.argv[1:] = ["--help"]\n'
+        'try:\n'
+        '    %s()\n'
+        'except SystemExit:\n'
+        '    pass\n')
+
+# Sphinx has already loaded itself and docutils when it sets up the
+# extension, so only the time after that is measured
+_SPHINX = ('import os, sys, time\n'
+           'import sphinx.application, sphinx.parsers\n'
+           'sys.path.insert(0, os.path.join(os.environ["PYTHONPATH"], '
+           '"db4sphinx"))\n'
+           'class App(object):\n'
+           '    def __getattr__(self, name):\n'
+           '        return lambda *args, **kwargs: None\n'
+           'start = time.time()\n'
+           'import ext\n'
+           'ext.setup(App())\n'
+           'sys.stderr.write("%f\\n" % (time.time() - start))\n')
+
+# name, code, budget in milliseconds
+ENTRY_POINTS = (
+    ('python-db2pseudoxml --help',
+     _CLI % ('scripts', 'db2pseudoxml', 'db2pseudoxml'), 50),
+    ('python-db2html --help',
+     _CLI % ('scripts', 'db2html', 'db2html'), 150),
+    ('python-db2assembly --help',
+     _CLI % ('scripts', 'db2assembly', 'db2assembly'), 40),
+    ('python-db4sphinx-preview --help',
+     _CLI % ('server', 'preview', 'preview'), 25),
+    ('Sphinx extension setup', _SPHINX, 15),
+)
+
+def _run(code, path, args=()):
+    env = dict(os.environ, PYTHONPATH=path)
+    start = time.time()
+    process = subprocess.Popen([sys.executable] + list(args) + ['-c', code],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               env=env)
+    _, err = process.communicate()
+    elapsed = time.time() - start
+    if process.returncode:
+        raise RuntimeError(err.decode('utf-8', 'replace'))
+    return elapsed, err.decode('utf-8', 'replace')
+
+def measure(code, runs, path):
+    """
+    best time of `runs` executions of code, minus the interpreter startup,
+    with the package in the directory path
+    """
+    if code is _SPHINX:
+        return min(float(_run(code, path)[1].split()[-1]) for _ in range(runs))
+    baseline = min(_run('pass', path)[0] for _ in range(runs))
+    return max(0.0, min(_run(code, path)[0] for _ in range(runs)) - baseline)
+
+def import_times(code, count, path):
+    "return the `count` slowest imports of code, as (cumulative us, module)"
+    _, err = _run(code, path, ['-X', 'importtime'])
+    result = []
+    for line in err.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, module = line.split('|')
+            try:
+                result.append((int(cumulative), module.rstrip()))
+            except ValueError:
+                pass    # header line
+    return sorted(result, reverse=True)[:count]
+
+def _check(args, path):
+    "measure the entry points, and return how many are over budget"
+    over = 0
+    for name, code, budget in ENTRY_POINTS:
+        budget *= args.scale
+        try:
+            elapsed = measure(code, args.runs, path) * 1000
+        except (RuntimeError, EnvironmentError) as e:
+            print('%-34s  skipped: %s'
+                  % (name, str(e).strip().split('\n')[-1]))
+            continue
+        status = 'ok' if elapsed <= budget else 'OVER BUDGET'
+        over += elapsed > budget
+        print('%-34s %6.1f ms  (budget %5.1f ms)  %s'
+              % (name, elapsed, budget, status))
+        if args.importtime:
+            for cumulative, module in import_times(code, args.importtime,
+                                                   path):
+                print('    %8.1f ms  %s' % (cumulative / 1000.0, module))
+    return over
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Checks the startup time of the db4sphinx entry points.')
+    parser.add_argument('-n', '--runs', type=int, default=5,
+                        help='runs per entry point; the best one counts '
+                             '(default: 5)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the budgets, e.g. for slow machines')
+    parser.add_argument('--importtime', type=int, metavar='N', nargs='?',
+                        const=10, default=0,
+                        help='show the N slowest imports of each entry point')
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='db4sphinx-startup-')
+    try:
+        package = os.path.join(path, 'db4sphinx')
+        shutil.copytree(os.path.join(ROOT, 'db4sphinx'), package,
+                        ignore=shutil.ignore_patterns('__pycache__', '*.pyc'))
+        compileall.compile_dir(package, quiet=1)
+        over = _check(args, path)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    sys.exit(1 if over else 0)
+
+if __name__ == '__main__':
+    main()
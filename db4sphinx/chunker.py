@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+    Split DocBook books into topics and an assembly
+    ===============================================
+    This does the same job as ``topic-maker-chunk.xsl`` from the DocBook
+    distribution, but in a single streaming pass over the book: each
+    chunk is written out and dropped from memory as soon as it has been
+    parsed.  Topics whose content did not change are not rewritten, so
+    that Sphinx does not consider them outdated.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import copy
+import itertools
+import lxml.etree
+import os
+import re
+import sys
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    from db4sphinx import xinclude
+except ImportError:
+    import xinclude
+
+DB5_NS = '{http://docbook.org/ns/docbook}'
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+
+class _Reporter(object):
+    def error(self, message, line=None):
+        if line is None:
+            sys.stderr.write('error: %s\n' % message)
+        else:
+            sys.stderr.write('line %d: error: %s\n' % (line, message))
+
+def _write_if_changed(filename, data):
+    """
+    Write `data` to `filename` unless the file already has the same
+    content.  Return True if the file was written.
+    """
+    try:
+        if os.path.getsize(filename) == len(data):
+            with open(filename, 'rb') as f:
+                if f.read() == data:
+                    return False
+    except EnvironmentError:
+        pass
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return True
+
+class AssemblyChunker(object):
+    '''
+    Split a DocBook book (or set, or article) into one topic per chunk,
+    plus an assembly whose structure mirrors the nesting of the chunks.
+    Every chunk becomes a section; its title becomes the description of
+    the resource.
+    '''
+
+    # elements that always start a new chunk
+    _COMPONENTS = ('set', 'book', 'part', 'reference', 'article',
+                   'preface', 'chapter', 'appendix', 'glossary',
+                   'bibliography', 'colophon', 'dedication', 'refentry')
+
+    _SECTIONS = ('section', 'sect1', 'sect2', 'sect3', 'sect4', 'sect5')
+
+    def __init__(self, base_dir='topics/', assembly_filename='index.xml',
+                 section_depth=1, jobs=None, xinclude=True):
+        self.base_dir = base_dir
+        self.assembly_filename = assembly_filename
+        self.section_depth = section_depth
+        self.jobs = jobs
+        self.xinclude = xinclude
+
+    def chunk(self, source):
+        """
+        Split `source`, a filename or a file object.  Return a tuple
+        with the number of files that were written and the number of
+        files that were already up to date.  Afterwards, the
+        `dependencies` attribute holds the set of files that were
+        included by `source`.
+        """
+        self.dependencies = set()
+        self._ns = None
+        self._chunks = []       # [el, resource, children] for open chunks
+        self._section_level = 0
+        self._include_depth = 0
+        self._ids = set()
+        self._counters = {}
+        self._remove = []
+        self._resources = []
+        self._structure = None
+
+        if not os.path.isdir(self.base_dir):
+            os.makedirs(self.base_dir)
+        pool = ThreadPool(self.jobs)
+        self._results = []
+        try:
+            self._resolver = xinclude.XIncludeResolver(
+                xinclude.FragmentCache(), self._load_xml, _Reporter())
+            events = lxml.etree.iterparse(source, events=('start', 'end'),
+                                          remove_comments=False)
+            self._process(events, pool)
+            self._flush_removals()
+            self._write(pool, self.assembly_filename, self._assembly())
+            pool.close()
+            written = sum(1 for r in self._results if r.get())
+        finally:
+            pool.terminate()
+        return written, len(self._results) - written
+
+    def _load_xml(self, path):
+        return lxml.etree.parse(path).getroot()
+
+    def _process(self, events, pool):
+        for event, el in events:
+            self._flush_removals()
+            if el.tag == xinclude.XI_INCLUDE and self.xinclude:
+                if event == 'start':
+                    self._include_depth += 1
+                    continue
+                self._include_depth -= 1
+                if self._include_depth:
+                    continue
+                for child in self._resolve(el):
+                    walk = lxml.etree.iterwalk(child, events=('start', 'end'))
+                    self._process(walk, pool)
+            elif self._include_depth:
+                # the fallback of an xi:include
+                continue
+            elif isinstance(el.tag, str):
+                if event == 'start':
+                    self._start(el)
+                else:
+                    self._end(el, pool)
+
+    def _resolve(self, el):
+        "resolve an xi:include, and return the elements that replace it"
+        parent = el.getparent()
+        prev = el.getprevious()
+        next = el.getnext()
+        self.dependencies.update(path for path, _ in self._resolver.resolve(el))
+        children = parent.iterchildren() if prev is None else prev.itersiblings()
+        return list(itertools.takewhile(lambda x: x is not next, children))
+
+    def _flush_removals(self):
+        # a chunk is taken out of its parent only once the parser or
+        # iterwalk has moved past it
+        for el in self._remove:
+            el.getparent().remove(el)
+        del self._remove[:]
+
+    def _local(self, el):
+        tag = el.tag
+        if self._ns is None:
+            self._ns = tag[:tag.index('}') + 1] if tag[0] == '{' else ''
+        if tag.startswith(self._ns):
+            return tag[len(self._ns):]
+        return None
+
+    def _start(self, el):
+        tag = self._local(el)
+        if tag in self._SECTIONS:
+            self._section_level += 1
+            if self._section_level > self.section_depth:
+                return
+        elif tag not in self._COMPONENTS and self._chunks:
+            return
+
+        xml_id = el.get(XML_ID) or el.get('id') or self._new_id(tag)
+        self._ids.add(xml_id)
+        # the description is filled in when the title has been parsed
+        resource = [xml_id, None]
+        self._resources.append(resource)
+        children = []
+        if self._chunks:
+            self._chunks[-1][2].append((xml_id, children))
+        else:
+            self._structure = (xml_id, children)
+        self._chunks.append([el, resource, children])
+
+    def _new_id(self, tag):
+        while True:
+            n = self._counters.get(tag, 0) + 1
+            self._counters[tag] = n
+            xml_id = '%s%d' % (tag or 'topic', n)
+            if xml_id not in self._ids:
+                return xml_id
+
+    def _end(self, el, pool):
+        tag = self._local(el)
+        if tag in self._SECTIONS:
+            self._section_level -= 1
+        if not self._chunks or self._chunks[-1][0] is not el:
+            return
+
+        _, resource, _ = self._chunks.pop()
+        xml_id = resource[0]
+        resource[1] = self._title(el)
+        el.tag = self._ns + 'section'
+        if not el.get(XML_ID) and not el.get('id'):
+            el.set(XML_ID if self._ns else 'id', xml_id)
+        el.tail = None
+        data = lxml.etree.tostring(el, encoding='utf-8', xml_declaration=True)
+        self._write(pool, os.path.join(self.base_dir, xml_id + '.xml'), data)
+        if self._chunks:
+            self._remove.append(el)
+
+    def _title(self, el):
+        "return the title of el as a string, and make it a child of el"
+        title = el.find(self._ns + 'title')
+        if title is None:
+            for info in ('info', 'bookinfo', 'articleinfo', 'setinfo'):
+                title = el.find(self._ns + info + '/' + self._ns + 'title')
+                if title is not None:
+                    # sections need a title outside the info element
+                    title = copy.deepcopy(title)
+                    title.tail = el.text
+                    el.text = None
+                    el.insert(0, title)
+                    break
+        if title is None:
+            return None
+        return re.sub(r'\s+', ' ', ''.join(title.itertext())).strip()
+
+    def _write(self, pool, filename, data):
+        self._results.append(pool.apply_async(_write_if_changed,
+                                              (filename, data)))
+
+    def _assembly(self):
+        assembly = lxml.etree.Element(DB5_NS + 'assembly',
+                                      nsmap={None: DB5_NS[1:-1]},
+                                      version='5.1')
+        assembly.text = '\n'
+        resources = lxml.etree.SubElement(assembly, DB5_NS + 'resources')
+        base = os.path.relpath(self.base_dir,
+                               os.path.dirname(self.assembly_filename) or '.')
+        resources.set(XML_BASE, base.replace(os.sep, '/') + '/')
+        resources.text = resources.tail = '\n'
+        for xml_id, description in self._resources:
+            resource = lxml.etree.SubElement(resources, DB5_NS + 'resource')
+            resource.set(XML_ID, xml_id)
+            resource.set('fileref', xml_id + '.xml')
+            resource.tail = '\n'
+            if description is not None:
+                lxml.etree.SubElement(resource,
+                                      DB5_NS + 'description').text = description
+
+        xml_id, children = self._structure
+        structure = lxml.etree.SubElement(assembly, DB5_NS + 'structure',
+                                          resourceref=xml_id)
+        structure.tail = '\n'
+        self._add_modules(structure, children)
+        return lxml.etree.tostring(assembly, encoding='utf-8',
+                                   xml_declaration=True)
+
+    def _add_modules(self, parent, children):
+        # explicit stack, chunks can be nested deeply
+        stack = [(parent, iter(children))]
+        while stack:
+            parent, it = stack[-1]
+            for xml_id, grandchildren in it:
+                module = lxml.etree.SubElement(parent, DB5_NS + 'module',
+                                               resourceref=xml_id)
+                stack.append((module, iter(grandchildren)))
+                break
+            else:
+                stack.pop()
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+    Command line front-end for docutils
+    ===================================
+    Runs the docutils publisher with the DocBook parser, for one file or,
+    with --output-dir, for many files in a pool of processes.  The
+    entry points in db4sphinx.scripts import this module only when they
+    are run, so that the other commands do not pay for docutils.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import copy
+import os
+import sys
+import warnings
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from docutils import SettingsSpec
+from docutils.core import Publisher, default_description
+from docutils.frontend import OptionParser
+from db4sphinx.dbparser import DocbookParser, DocbookFileInput
+
+usage = ('%prog [options] [<source> [<destination>]]\n'
+         '  %prog [options] --output-dir <directory> <source>...')
+
+class BatchSettingsSpec(SettingsSpec):
+    settings_spec = (
+        'Batch Options', None,
+        (('Convert all the <source> files, and the .xml files in the '
+          '<source> directories, into <directory>.',
+          ['--output-dir', '-O'], {'metavar': '<directory>'}),
+         ('Number of files to convert in parallel, with --output-dir '
+          '(default: number of CPUs).',
+          ['--jobs', '-j'], {'type': 'int', 'metavar': '<n>'}),
+         ('Keep running, and convert the sources again when they or the '
+          'files that they include change.',
+          ['--watch'], {'action': 'store_true'}),
+         ('With --watch, check the files every second instead of using '
+          'inotify.',
+          ['--watch-poll'], {'action': 'store_true'}),))
+
+class BatchOptionParser(OptionParser):
+    def check_values(self, values, args):
+        values._sources = None
+        if values.output_dir is not None:
+            # the positional arguments are all sources
+            values._sources, args = args, []
+            if not values._sources:
+                self.error('No source files given.')
+        elif values.jobs is not None:
+            self.error('--jobs requires --output-dir.')
+        elif values.watch and (len(args) != 2 or '-' in args):
+            self.error('--watch requires a source and a destination file, '
+                       'or --output-dir.')
+        return OptionParser.check_values(self, values, args)
+
+def publish_cmdline(reader=None, writer=None, writer_name='pseudoxml',
+                    description=default_description, suffix=None):
+    # like docutils.core.publish_cmdline, but let lxml read the file
+    publisher = Publisher(reader, DocbookParser(), writer,
+                          source_class=DocbookFileInput)
+    publisher.set_components('standalone', 'restructuredtext', writer_name)
+    with warnings.catch_warnings():
+        # docutils >= 0.19 deprecates OptionParser, without a replacement
+        warnings.simplefilter('ignore', DeprecationWarning)
+        option_parser = BatchOptionParser(
+            components=(publisher.parser, publisher.reader, publisher.writer,
+                        BatchSettingsSpec()),
+            read_config_files=True, usage=usage, description=description)
+    settings = publisher.settings = option_parser.parse_args(sys.argv[1:])
+    if settings.output_dir is not None:
+        jobs, errors = _batch_jobs(settings._sources, settings.output_dir,
+                                   suffix or '.' + writer_name)
+    elif settings.watch:
+        jobs, errors = [(settings._source, settings._destination)], []
+    else:
+        try:
+            publisher.publish(enable_exit_status=True)
+        finally:
+            publisher.parser.save_handler_profiles()
+        return
+    sys.exit(publish_batch(publisher, jobs, errors))
+
+def _batch_jobs(sources, output_dir, suffix):
+    """
+    Return a list of (source, destination) pairs for the files in
+    sources, and a list of (source, error message) pairs for the files
+    that cannot be converted.
+    """
+    output_dir = os.path.abspath(output_dir)
+    jobs = []
+    errors = []
+    destinations = {}
+    for source in sources:
+        if os.path.isdir(source):
+            files = []
+            for dirpath, dirnames, filenames in os.walk(source):
+                dirnames[:] = sorted(
+                    d for d in dirnames
+                    if os.path.abspath(os.path.join(dirpath, d)) != output_dir)
+                files.extend(os.path.join(dirpath, f)
+                             for f in sorted(filenames) if f.endswith('.xml'))
+            names = [os.path.relpath(f, source) for f in files]
+        else:
+            files = [source]
+            names = [os.path.basename(source)]
+
+        for path, name in zip(files, names):
+            destination = os.path.join(output_dir,
+                                       os.path.splitext(name)[0] + suffix)
+            if os.path.abspath(path) == destination:
+                errors.append((path, 'would overwrite the source file'))
+            elif destination in destinations:
+                errors.append((path, 'same destination as %s' %
+                               destinations[destination]))
+            else:
+                destinations[destination] = path
+                jobs.append((path, destination))
+    return jobs, errors
+
+_worker_state = None
+
+def _init_worker(reader_class, parser_class, writer_class, settings):
+    global _worker_state
+    _worker_state = (reader_class, parser_class, writer_class, settings)
+
+def _convert(job):
+    """
+    Convert one file, and return its exit status, its messages, the
+    files that it includes and the handler profiles of the worker.
+    """
+    from docutils.utils import DependencyList
+
+    source, destination = job
+    reader_class, parser_class, writer_class, settings = _worker_state
+    settings = copy.copy(settings)
+    settings._source = source
+    settings._destination = destination
+    settings.record_dependencies = dependencies = DependencyList()
+
+    # components keep per-document state, so each file gets new ones
+    stderr = sys.stderr
+    sys.stderr = messages = StringIO()
+    try:
+        publisher = Publisher(reader_class(), parser_class(), writer_class(),
+                              source_class=DocbookFileInput, settings=settings)
+        try:
+            publisher.publish(enable_exit_status=True)
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+    finally:
+        sys.stderr = stderr
+    # the main process saves them, so that workers do not overwrite
+    # each other's files
+    profiles = parser_class.take_handler_profiles()
+    return job, status, messages.getvalue(), dependencies.list, profiles
+
+def _run_jobs(run, jobs, errors, watcher):
+    "convert jobs with run, report the outcome and return the exit status"
+    exit_status = 0
+    failed = 0
+    for source, message in errors:
+        sys.stderr.write('%s: error: %s\n' % (source, message))
+        exit_status = 1
+        failed += 1
+    for job, status, messages, dependencies, profiles in run(jobs):
+        source = job[0]
+        DocbookParser.merge_handler_profiles(profiles)
+        if watcher is not None:
+            watcher.set_dependencies(job, [source] + dependencies)
+        sys.stderr.write(messages)
+        if status:
+            sys.stderr.write('%s: failed (exit status %d)\n' %
+                             (source, status))
+            exit_status = max(exit_status, status)
+            failed += 1
+        else:
+            sys.stderr.write('%s: ok\n' % source)
+    DocbookParser.save_handler_profiles()
+
+    sys.stderr.write('%d files converted, %d failed\n' %
+                     (len(jobs) + len(errors) - failed, failed))
+    return exit_status
+
+def publish_batch(publisher, jobs, errors):
+    """
+    Convert jobs, a list of (source, destination) pairs, using a pool of
+    publisher.settings.jobs processes.  Report the outcome for each file
+    on stderr and return the highest exit status.
+
+    With publisher.settings.watch, keep converting the files again
+    when they or their XIncludes change, until interrupted.
+    """
+    import multiprocessing
+
+    settings = publisher.settings
+    for directory in set(os.path.dirname(d) for _, d in jobs):
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    initargs = (type(publisher.reader), type(publisher.parser),
+                type(publisher.writer), settings)
+    if settings.jobs == 1 or len(jobs) <= 1:
+        pool = None
+        _init_worker(*initargs)
+        run = lambda jobs: map(_convert, jobs)
+    else:
+        # each worker imports lxml and docutils once, for all its files
+        pool = multiprocessing.Pool(settings.jobs, _init_worker, initargs)
+        run = lambda jobs: pool.imap(_convert, jobs)
+
+    watcher = None
+    if settings.watch:
+        from db4sphinx.watch import Watcher
+        watcher = Watcher(polling=settings.watch_poll)
+        # changes to the sources during the first run are not missed
+        for job in jobs:
+            watcher.set_dependencies(job, [job[0]])
+
+    # returned if the first run is interrupted in --watch mode
+    exit_status = 130
+    try:
+        exit_status = _run_jobs(run, jobs, errors, watcher)
+        while watcher is not None:
+            sys.stderr.write('Watching for changes%s, press Ctrl-C to stop.\n'
+                             % (' (polling)' if watcher.polling else ''))
+            changed = set(watcher.wait())
+            exit_status = _run_jobs(run, [j for j in jobs if j in changed],
+                                    [], watcher)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    except KeyboardInterrupt:
+        if watcher is None:
+            raise
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if watcher is not None:
+            watcher.close()
+    return exit_status
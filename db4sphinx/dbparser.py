@@ -10,14 +10,24 @@
     :license: MIT.
 """
 
+import itertools
 import lxml.etree
-from io import BytesIO
+import mmap
+import os
+import sys
+import threading
 
 import re
 
+import docutils.io
 import docutils.parsers
 from docutils import nodes
 
+try:
+    from db4sphinx import xinclude
+except ImportError:
+    import xinclude
+
 __version__ = '0.0.1'
 __contributors__ = ('Kurt McKee <contactme@kurtmckee.org>',
                     'Anthony Scopatz <ascopatz@enthought.com>',
@@ -27,6 +37,71 @@ __contributors__ = ('Kurt McKee <contactme@kurtmckee.org>',
 
 # missing: images, bibliography, ...
 
+def _import_profiling():
+    try:
+        from db4sphinx import profiling
+    except ImportError:
+        import profiling
+    return profiling
+
+def _import_doctreecache():
+    # the cache is optional, and it needs hashlib and pickle; importing
+    # them takes about as long as importing this module
+    try:
+        from db4sphinx import doctreecache
+    except ImportError:
+        import doctreecache
+    return doctreecache
+
+# idle lxml parsers, reused by DocbookParser in the thread that created them
+_xml_parsers = threading.local()
+
+def stack_safe(method):
+    '''
+    Mark an e_tag() method as usable by the explicit-stack engine.
+    The last call that the method makes to block, concat, concat_into
+    or visit_children may return before the children are converted;
+    anything that has to run after them must be registered with defer().
+    '''
+    method.stack_safe = True
+    return method
+
+def _first_text(parent, start):
+    """
+    The first Text node in parent.children[start:] and their descendants,
+    as the node that holds it and its index there; (None, None) if there
+    is none.
+    """
+    stack = [(parent, start)]
+    while stack:
+        node, i = stack.pop()
+        if i >= len(node.children):
+            continue
+        stack.append((node, i + 1))
+        child = node.children[i]
+        if isinstance(child, nodes.Text):
+            return node, i
+        stack.append((child, 0))
+    return None, None
+
+class _Frame(object):
+    ''' children of an element whose conversion is in progress '''
+
+    __slots__ = ('children', 'parent', 'pending', 'need_space', 'text',
+                 'flush', 'defers', 'close')
+
+    def __init__(self, el, parent, need_space, text, flush):
+        self.children = iter(el)
+        self.parent = parent
+        self.pending = el.text if text else None
+        if self.pending is not None and not need_space:
+            self.pending = self.pending.lstrip()
+        self.need_space = need_space
+        self.text = text            # False for visit_children
+        self.flush = flush          # where block() puts footnotes
+        self.defers = None          # see DocbookConverter.defer
+        self.close = False          # pop _stack when done
+
 class DocbookConverter(object):
     ''' converts DocBook tree into docutils nodes '''
 
@@ -46,15 +121,35 @@ class DocbookConverter(object):
         self._anchors = []
         # function to be called to convert <title>
         self._title_handler = None
-        # a function that is used as _text_mangle_fn inside <listitem>
-        self._listitem_mangle_fn = None
-        # a function that is used to modify the first text node after
-        # it is assigned a non-None value
-        self._text_mangle_fn = None
+        # TEXT_RULES entry that <listitem> passes to text_rule
+        self._listitem_rule = None
+        # (rule, parent node, index of its next child) for apply_text_rules
+        self._text_rules = []
+        # TEXT_RULES, changed by the text_rules setting
+        self._text_rule_table = self._get_text_rules(
+            parser.get_setting(document, 'text_rules'))
         # used to pick arabic numbers vs. lowercase letters
         self._ordered_list_depth = 0
         # maintained for use in rST state machine
         self.current_level = 0
+        # functions to be called when the current element is closed
+        self._defers = None
+        # convert without recursing on each element, see _run
+        self.explicit_stack = parser.get_setting(document, 'explicit_stack')
+        # true while a stack_safe method can leave its children to _run
+        self._deferring = False
+        # the children left to _run by a stack_safe method
+        self._frame = None
+        # false if the conversion had effects outside the document
+        self.cacheable = True
+        # with --diagnostics=summary, key -> [count, first message, lines]
+        self._diagnostics = None
+        if parser.get_setting(document, 'diagnostics') == 'summary':
+            self._diagnostics = {}
+        # statistics on the e_tag() methods, see profiling.py
+        self.profile = parser._get_handler_profile(document)
+        if self.profile is not None:
+            self.profile.instrument(self)
 
         if ns:
             # DocBook 5
@@ -64,58 +159,312 @@ class DocbookConverter(object):
             # DocBook 4
             self._ns = ''
             self._id_attrib = 'id'
+        self._dispatch = self._dispatch_table(self._ns)
 
     def _conv(self, el, parent):
         '''
         Element to string conversion.
-        Looks for a defined function e_tag() and calls it,
-        where tag is the element name.
-        The function e_tag() has one argument,
-        the DocBook element node to process.
+        Looks up the e_tag() method for the element in the
+        dispatch table and calls it, where tag is the element name.
+        The function e_tag() has two arguments, the DocBook
+        element node to process and the parent docutils node.
         '''
         if parent is None:
             parent = self.document
+        if self.explicit_stack:
+            self._run(el, parent)
+            return
 
-        if isinstance(el, lxml.etree._ProcessingInstruction):
-            self.info(el, "ignoring ProcessingInstruction for now")
-            return ""
-        if isinstance(el, lxml.etree._Comment):
-            if el.text.strip():
-                self.comment(el, parent)
-                return
+        try:
+            tag, method, safe = self._dispatch[el.tag]
+        except KeyError:
+            if isinstance(el, lxml.etree._ProcessingInstruction):
+                self.info(el, "ignoring ProcessingInstruction for now")
+                return ""
+            if isinstance(el, lxml.etree._Comment):
+                if el.text.strip():
+                    self.comment(el, parent)
+                    return
+            tag, method, safe = self._lookup(el)
+
+        self._stack.append(tag)
+        if self.profile is not None:
+            self.profile.enter(tag, method)
+        save_defers = self._defers
+        self._defers = None
+        if method is not None:
+            method(self, el, parent)   # call the e_tag(el) method
+        else:
+            self._not_handled(el, parent)
+        if self._defers is not None:
+            self._run_defers(self._defers)
+        self._defers = save_defers
+        if self.profile is not None:
+            self.profile.exit()
+        self._stack.pop()
+
+    def _not_handled(self, el, parent):
+        if el.tag not in self._not_handled_tags:
+            self.warning(el, "Don't know how to handle <%s>" % el.tag)
+            self._not_handled_tags.add(el.tag)
+        self.concat(el, parent)
+
+    def defer(self, fn, *args):
+        '''
+        Call fn(*args) after the children of the element being converted,
+        and before the element itself is popped from _stack.
+        '''
+        if self._defers is None:
+            self._defers = []
+        self._defers.append((fn, args))
+
+    def _run_defers(self, defers):
+        for fn, args in defers:
+            fn(*args)
 
+    # explicit-stack engine.  Methods marked with stack_safe leave the
+    # conversion of their children to _run; everything else recurses
+    # as usual, and _run is reentered for each of their children.
+
+    def _run(self, el, parent):
+        '''
+        Convert el into parent, keeping the open elements in a list
+        of _Frame objects instead of the Python stack.
+        '''
+        save = self._defers, self._deferring, self._frame
+        frames = []
+        frame = self._start(el, parent)
+        if frame is not None:
+            frames.append(frame)
+        while frames:
+            frame = frames[-1]
+            child = next(frame.children, None)
+            pending = frame.pending
+            if child is None:
+                frames.pop()
+                if pending is not None:
+                    if not frame.need_space:
+                        pending = pending.rstrip()
+                    if len(pending):
+                        frame.parent += self.text(pending)
+                self._end(frame)
+                continue
+
+            if pending is not None and len(pending):
+                frame.parent += self.text(pending)
+            if frame.text:
+                frame.pending = child.tail
+            frame = self._start(child, frame.parent)
+            if frame is not None:
+                frames.append(frame)
+        self._defers, self._deferring, self._frame = save
+
+    def _start(self, el, parent):
+        '''
+        Call the e_tag() method for el.  Return the _Frame for its
+        children if the method left them to _run, otherwise close el
+        and return None.
+        '''
+        try:
+            tag, method, safe = self._dispatch[el.tag]
+        except KeyError:
+            if isinstance(el, lxml.etree._ProcessingInstruction):
+                self.info(el, "ignoring ProcessingInstruction for now")
+                return None
+            if isinstance(el, lxml.etree._Comment):
+                if el.text.strip():
+                    self.comment(el, parent)
+                    return None
+            tag, method, safe = self._lookup(el)
+
+        self._stack.append(tag)
+        if self.profile is not None:
+            self.profile.enter(tag, method)
+        self._defers = None
+        self._frame = None
+        if method is not None:
+            self._deferring = safe
+            method(self, el, parent)   # call the e_tag(el) method
+        else:
+            self._deferring = True
+            self._not_handled(el, parent)
+        self._deferring = False
+
+        frame = self._frame
+        if frame is None:
+            if self._defers is not None:
+                self._run_defers(self._defers)
+            if self.profile is not None:
+                self.profile.exit()
+            self._stack.pop()
+            return None
+        self._frame = None
+        frame.defers = self._defers
+        frame.close = True
+        return frame
+
+    def _end(self, frame):
+        if frame.flush is not None:
+            self.flush_footnotes(frame.flush)
+        if frame.close:
+            if frame.defers is not None:
+                self._run_defers(frame.defers)
+            if self.profile is not None:
+                self.profile.exit()
+            self._stack.pop()
+
+    @classmethod
+    def _dispatch_table(cls, ns):
+        '''
+        Return a dictionary mapping Clark-notation tags to a tuple of
+        the tag name pushed on _stack, the e_tag() function and whether
+        the function is stack_safe.  The table is built once per class
+        and default namespace, and covers both the default namespace
+        and the prefixes listed in _NSMAP.
+        '''
+        tables = cls.__dict__.get('_dispatch_tables')
+        if tables is None:
+            tables = {}
+            cls._dispatch_tables = tables
+        table = tables.get(ns)
+        if table is not None:
+            return table
+
+        table = {}
+        for name in dir(cls):
+            if not name.startswith('e_'):
+                continue
+            method = getattr(cls, name)
+            safe = getattr(method, 'stack_safe', False)
+            tag = name[2:]
+            table[ns + tag] = (tag, method, safe)
+            for uri, prefix in cls._NSMAP.items():
+                if tag.startswith(prefix + '_'):
+                    clark = '{%s}%s' % (uri, tag[len(prefix) + 1:])
+                    table[clark] = (clark, method, safe)
+        tables[ns] = table
+        return table
+
+    def _lookup(self, el):
+        "slow path of _conv, for elements not in the dispatch table"
         tag = str(el.tag)
-        method_name = None
-        if tag.find(self._ns) == 0:
-            # strip off the default namespace
-            tag = tag[len(self._ns):]
-            method_name = 'e_' + tag
-        elif tag.startswith("{"):
+        if tag.startswith("{") and not (self._ns and tag.startswith(self._ns)):
             # identify other namespaces by prefix used in XML file
             ns, rawTag = tag[1:].split("}")
-            prefix = self._NSMAP.get(ns, None)
-            if prefix is None:
+            if self._NSMAP.get(ns, None) is None:
                 if ns not in self._not_handled_ns:
                     self.warning(el, "Don't know how to handle namespace %s" % ns)
                 self._not_handled_tags.add(el.tag)
-            else:
-                method_name = "e_%s_%s" % (prefix, rawTag)
+                return tag, None, True
+        elif tag.startswith(self._ns):
+            # strip off the default namespace
+            tag = tag[len(self._ns):]
 
-        self._stack.append(tag)
-        if method_name is not None and hasattr(self, method_name):
-            getattr(self, method_name)(el, parent)   # call the e_tag(el) method
-        else:
-            if el.tag not in self._not_handled_tags:
-                self.warning(el, "Don't know how to handle <%s>" % el.tag)
-                self._not_handled_tags.add(el.tag)
-            self.concat(el, parent)
-        self._stack.pop()
+        # not stored in the table, which is shared by all the converters
+        # of the class; _conv warns about unknown elements
+        return tag, None, True
 
     def nested_convert(self, el, node):
         self._conv(el, node)
+        self.finish()
 
     def convert_root(self, el):
         self._conv(el, self.document)
+        self.finish()
+
+    def finish(self):
+        "run what needs the whole converted document"
+        self.apply_text_rules()
+        self.report_diagnostics()
+
+    # streaming conversion.  Elements listed here are opened as soon as
+    # they start, if their e_tag() method is stack_safe; their children
+    # are converted when they end and then dropped from the source tree.
+
+    _STREAM_CONTAINERS = ('set', 'book', 'part', 'reference', 'article',
+                          'preface', 'chapter', 'appendix')
+
+    def convert_events(self, root, events):
+        '''
+        Convert the document from lxml parse events.  root is the
+        element of the first 'start' event, and events yields the
+        ('start', 'end', 'comment' and 'pi') events that follow it.
+        '''
+        containers = set(self._ns + tag for tag in self._STREAM_CONTAINERS)
+        opened = []             # [el, frame, last converted child, depth]
+        depth = 1               # of the innermost element being parsed
+        if self._is_container(root, containers):
+            self._open_container(root, self.document, depth, opened)
+        for event, el in events:
+            if event == 'start':
+                depth += 1
+            elif event == 'end':
+                depth -= 1
+            if not opened:
+                # root was not opened, or trailing comments and PIs
+                if el is root and event == 'end':
+                    self.parser.resolve_xincludes(root, self.document)
+                    self._conv(root, self.document)
+                continue
+
+            top = opened[-1]
+            if event == 'start':
+                if depth == top[3] + 1 and self._is_container(el, containers):
+                    self._stream_text(top, False)
+                    self._open_container(el, top[1].parent, depth, opened)
+            elif depth == top[3] - 1:
+                # end of the innermost open container
+                opened.pop()
+                self._stream_text(top, True)
+                self._end(top[1])
+                if opened:
+                    opened[-1][2] = el
+                del el[:]
+            elif depth == top[3]:
+                for child in self._resolve_unit(el):
+                    self._stream_text(top, False)
+                    self._conv(child, top[1].parent)
+                    top[2] = child
+                    del child[:]
+        self.finish()
+
+    def _resolve_unit(self, el):
+        "resolve XIncludes in el, and return the elements that replace it"
+        parent = el.getparent()
+        prev = el.getprevious()
+        next = el.getnext()
+        self.parser.resolve_xincludes(el, self.document)
+        if el.getparent() is not None:
+            return (el,)
+        # el was an xi:include; lxml may have parsed more siblings already
+        children = parent.iterchildren() if prev is None else prev.itersiblings()
+        return list(itertools.takewhile(lambda x: x is not next, children))
+
+    def _is_container(self, el, containers):
+        entry = self._dispatch.get(el.tag)
+        return el.tag in containers and entry is not None and entry[2]
+
+    def _open_container(self, el, parent, depth, opened):
+        frame = self._start(el, parent)
+        if frame is not None:
+            opened.append([el, frame, None, depth])
+
+    def _stream_text(self, top, last):
+        "emit the text that precedes the next child of an open container"
+        el, frame, prev, _ = top
+        if prev is None:
+            pending = el.text
+            if pending is not None and not frame.need_space:
+                pending = pending.lstrip()
+        else:
+            pending = prev.tail
+            el.remove(prev)
+        if pending is None or not frame.text:
+            return
+        if last and not frame.need_space:
+            pending = pending.rstrip()
+        if len(pending):
+            frame.parent += self.text(pending)
 
     def info(self, el, s):
         self.document.reporter.info(s, line=el.sourceline)
@@ -123,15 +472,56 @@ class DocbookConverter(object):
     def warning(self, el, s):
         self.document.reporter.warning(s, line=el.sourceline)
 
+    # number of lines listed for each kind of warning in summary mode
+    diagnostic_samples = 5
+
+    def diagnose(self, el, key, message):
+        '''
+        Warn about el.  message is a function that returns the text of
+        the warning, so that it is only formatted when it is needed.
+        With --diagnostics=summary, warnings with the same key, a tuple
+        of the kind of problem and the tags involved, are counted and
+        reported once at the end of the document.
+        '''
+        if self._diagnostics is None:
+            self.warning(el, message())
+            return
+        entry = self._diagnostics.get(key)
+        if entry is None:
+            self._diagnostics[key] = [1, message(), [el.sourceline]]
+            return
+        entry[0] += 1
+        if len(entry[2]) < self.diagnostic_samples:
+            entry[2].append(el.sourceline)
+
+    def report_diagnostics(self):
+        "report the warnings that were counted in summary mode"
+        if not self._diagnostics:
+            return
+        for count, message, lines in sorted(self._diagnostics.values(),
+                                            key=lambda x: x[2][0] or 0):
+            if count > 1:
+                message = '%s [%d times, at lines %s%s]' % (
+                    message, count, ', '.join(str(x) for x in lines),
+                    ', ...' if count > len(lines) else '')
+            self.document.reporter.warning(message, line=lines[0])
+        self._diagnostics.clear()
+
+    def _pattern(self, el):
+        "tags of el and of its parent, to group warnings in summary mode"
+        parent = el.getparent()
+        return (parent.tag if parent is not None else None), el.tag
+
     def supports_only(self, el, tags):
         "print warning if there are unexpected children"
         for i in el.getchildren():
             if i.tag not in tags:
-                self.warning(el, "%s/%s skipped." % (el.tag, i.tag))
+                self.diagnose(el, ('skipped', el.tag, i.tag),
+                              lambda: "%s/%s skipped." % (el.tag, i.tag))
 
     def what(self, el):
         "returns string describing the element, such as <para> or Comment"
-        if isinstance(el.tag, basestring):
+        if isinstance(el.tag, str):
             return "<%s>" % el.tag
         elif isinstance(el, lxml.etree._Comment):
             return "Comment"
@@ -140,20 +530,24 @@ class DocbookConverter(object):
 
     def has_only_text(self, el, parent):
         "print warning if there are any children"
-        if el.getchildren():
-            self.warning(el, "children of %s are skipped: %s" % (self.get_path(el, parent),
-                      ", ".join(self.what(i) for i in el.getchildren())))
+        if len(el):
+            self.diagnose(el, ('children',) + self._pattern(el),
+                          lambda: "children of %s are skipped: %s" % (
+                              self.get_path(el, parent),
+                              ", ".join(self.what(i) for i in el)))
 
     def has_no_text(self, el, parent):
         "print warning if there is any non-blank text"
         if el.text is not None and not el.text.isspace():
-            self.warning(el, "skipping text in <%s>: %s" %
+            self.diagnose(el, ('text',) + self._pattern(el),
+                          lambda: "skipping text in <%s>: %s" %
                                   (self.get_path(el, parent), el.text))
             return
         for i in el.getchildren():
             if i.tail is not None and not i.tail.isspace():
-                self.warning(el, "skipping text in <%s>: %s" %
-                                  (self.get_path(el, parent), i.tail))
+                self.diagnose(el, ('text',) + self._pattern(el),
+                              lambda: "skipping text in <%s>: %s" %
+                                      (self.get_path(el, parent), i.tail))
             return
 
     def create_node(self, parent, klass, xml_id=None, ids=None):
@@ -180,6 +574,14 @@ class DocbookConverter(object):
         return self.node(parent, klass, default_klass=default_klass, xml_id=xml_id)
 
     def concat_into(self, el, parent, need_space=True):
+        self._concat_into(el, parent, need_space, None)
+
+    def _concat_into(self, el, parent, need_space, flush):
+        if self._deferring:
+            self._deferring = False
+            self._frame = _Frame(el, parent, need_space, True, flush)
+            return
+
         pending = el.text
         if pending is not None:
             if not need_space:
@@ -196,7 +598,10 @@ class DocbookConverter(object):
                 pending = pending.rstrip()
             if len(pending):
                 parent += self.text(pending)
+        if flush is not None:
+            self.flush_footnotes(flush)
 
+    @stack_safe
     def concat(self, el, parent, klass=None, default_klass=nodes.inline,
                need_space=True):
         """
@@ -206,21 +611,28 @@ class DocbookConverter(object):
         self.concat_into(el, node, need_space)
         return node
 
+    @stack_safe
     def visit_children(self, el, parent):
+        if self._deferring:
+            self._deferring = False
+            self._frame = _Frame(el, parent, True, False, None)
+            return
         for i in el.getchildren():
             self._conv(i, parent)
 
+    @stack_safe
     def block(self, el, parent, klass=None):
-        node = self.concat(el, parent, klass, default_klass=nodes.compound,
-                           need_space=False)
+        node = self.create(el, parent, klass, default_klass=nodes.compound)
+        self._concat_into(el, node, False, parent)
+        return node
+
+    def flush_footnotes(self, parent):
         if len(self._save) == 0:
-            return node
-        # flush footnotes
+            return
         for i in self._save:
             parent += i
         self._save = []
-        return node
-        
+
     def inline_text(self, text, parent, inline_class=None, xml_id=None, ids=None):
         node = self.node(parent, nodes.inline, xml_id=xml_id, ids=ids)
         if inline_class is not None:
@@ -256,25 +668,43 @@ class DocbookConverter(object):
             need_sep = True
         return node
 
-    def no_markup_text(self, el, ids=[], need_space=False):
-        text = ''
-        xml_id = el.get(self._id_attrib)
-        if xml_id is not None:
-            ids += xml_id
-        if el.text is not None:
-            text += el.text
-            need_space = not el.text[-1].isspace()
-        for i in el.getchildren():
-            child_text, need_space = self.no_markup_text(i, ids, need_space)
-            text += child_text
-            if i.tail is not None:
+    def no_markup_text(self, el, ids=None, need_space=False):
+        '''
+        Return the text of el and its descendants, without the markup,
+        and whether text that follows needs a space.  Tails are
+        left-stripped unless a space is needed.  The xml ids of the
+        elements are appended to ids, if it is not None.
+        '''
+        pieces = []
+        append = pieces.append
+        id_attrib = self._id_attrib
+        stack = []
+        while True:
+            if el is not None:
+                # entering el
+                if ids is not None:
+                    xml_id = el.get(id_attrib)
+                    if xml_id is not None:
+                        ids.append(xml_id)
+                text = el.text
+                if text is not None:
+                    append(text)
+                    need_space = not text[-1].isspace()
+                stack.append((el, iter(el)))
+            else:
+                # leaving the last element on the stack
+                i, _ = stack.pop()
+                if not stack:
+                    break
                 tail = i.tail
-                if not need_space:
-                    tail = tail.lstrip()
-                if len(tail):
-                    text += tail
-                    need_space = not tail[-1].isspace()
-        return text, need_space
+                if tail is not None:
+                    if not need_space:
+                        tail = tail.lstrip()
+                    if len(tail):
+                        append(tail)
+                        need_space = not tail[-1].isspace()
+            el = next(stack[-1][1], None)
+        return ''.join(pieces), need_space
 
     def no_markup(self, el, parent, klass=nodes.inline):
         ids = []
@@ -284,13 +714,59 @@ class DocbookConverter(object):
         return node
 
     def text(self, string):
-        if self._text_mangle_fn is not None:
-            string = self._text_mangle_fn(string)
-            self._text_mangle_fn = None
         return nodes.Text(string)
 
+    # rewrites of text nodes, done by apply_text_rules once the document
+    # is converted: name -> (compiled pattern, replacement)
+    TEXT_RULES = {
+        # extra spaces look very ugly in sphinx output
+        'collapse_spaces': (re.compile(' +'), ' '),
+        # the bullet that makeinfo puts at the start of a listitem
+        'strip_bullet': (re.compile(r'\A[\s\S]\s*'), ''),
+    }
+
+    def _get_text_rules(self, changes):
+        """
+        Return TEXT_RULES with the changes given as a list of (name,
+        pattern, replacement) tuples.
+        """
+        if not changes:
+            return self.TEXT_RULES
+        rules = dict(self.TEXT_RULES)
+        for name, pattern, replacement in changes:
+            if name not in rules:
+                self.document.reporter.warning('unknown text rule "%s"' % name)
+                continue
+            try:
+                rules[name] = (re.compile(pattern), replacement)
+            except re.error as e:
+                self.document.reporter.error(
+                    'invalid pattern for text rule "%s": %s' % (name, e))
+        return rules
+
+    def text_rule(self, parent, rule):
+        '''
+        Apply the TEXT_RULES entry `rule` to the first text node that
+        is added to parent, or below it, after this call.
+        '''
+        self._text_rules.append((rule, parent, len(parent)))
+
+    def apply_text_rules(self):
+        # nodes are only ever appended during the conversion, so the
+        # indices are still valid
+        for rule, parent, start in self._text_rules:
+            owner, i = _first_text(parent, start)
+            if owner is None:
+                continue
+            pattern, replacement = self._text_rule_table[rule]
+            text = owner.children[i]
+            new = pattern.sub(replacement, text)
+            if new != text:
+                owner[i] = nodes.Text(new)
+        self._text_rules = []
+
     def has_any_text(self, el):
-        text, _ = self.no_markup_text(el, [], False)
+        text, _ = self.no_markup_text(el, None, False)
         return len(text.strip()) > 0
 
     def get_path(self, el, parent):
@@ -300,8 +776,16 @@ class DocbookConverter(object):
     def nop(self, el, parent):
         pass
 
+    def append_text(self, parent, string):
+        parent += self.text(string)
+
     # Title handling
 
+    def set_title_handler(self, handler):
+        "use handler for <title> until the current element is closed"
+        self.defer(setattr, self, '_title_handler', self._title_handler)
+        self._title_handler = handler
+
     @staticmethod
     def rubric(converter, el, parent):
         converter.block(el, parent, nodes.rubric)
@@ -326,29 +810,37 @@ class DocbookConverter(object):
             #    self._text_mangle_fn = lambda x: '%s %s' % (el.get('label'), x)
             converter.block(inner_el, inner_parent, nodes.title)
 
-        save_title_handler = self._title_handler
-        self._title_handler = section_title_handler
+        self.set_title_handler(section_title_handler)
         node = self.block(el, parent, nodes.section)
-        self._title_handler = save_title_handler
+        self.defer(self._close_section, node, level)
+
+    def _close_section(self, node, level):
         self.document.set_id(node)
         self.current_level = level
 
+    @stack_safe
     def e_chapter(self, el, parent):
         self._section(el, parent, 0)
+    @stack_safe
     def e_sect1(self, el, parent):
         self._section(el, parent, 1)
+    @stack_safe
     def e_sect2(self, el, parent):
         self._section(el, parent, 2)
+    @stack_safe
     def e_sect3(self, el, parent):
         self._section(el, parent, 3)
+    @stack_safe
     def e_section(self, el, parent):
         self._section(el, parent, self.current_level + 1)
+    @stack_safe
     def e_topic(self, el, parent):
         self._section(el, parent, self.current_level)
 
     e_preface = e_chapter
     e_appendix = e_chapter
 
+    @stack_safe
     def e_title(self, el, parent):
         if not self._title_handler is None:
             (self._title_handler)(self, el, parent)
@@ -361,38 +853,45 @@ class DocbookConverter(object):
 
     # other block elements
 
+    @stack_safe
     def e_blockquote(self, el, parent):
         self.block(el, parent, nodes.block_quote)
+    @stack_safe
     def e_epigraph(self, el, parent):
         self.block(el, parent, nodes.epigraph)
+    @stack_safe
     def e_sidebar(self, el, parent):
-        save_title_handler = self._title_handler
-        self._title_handler = self.rubric
+        self.set_title_handler(self.rubric)
         self.block(el, parent, nodes.sidebar)
-        self._title_handler = save_title_handler
 
+    @stack_safe
     def e_para(self, el, parent):
         self.block(el, parent, nodes.paragraph)
+    @stack_safe
     def e_formalpara(self, el, parent):
-        save_title_handler = self._title_handler
-        self._title_handler = self.rubric
+        self.set_title_handler(self.rubric)
         self.e_para(el, parent)
-        self._title_handler = save_title_handler
     e_simpara = e_para
 
+    @stack_safe
     def e_note(self, el, parent):
         return self.block(el, parent, nodes.note)
+    @stack_safe
     def e_caution(self, el, parent):
         return self.block(el, parent, nodes.caution)
+    @stack_safe
     def e_important(self, el, parent):
         return self.block(el, parent, nodes.important)
+    @stack_safe
     def e_tip(self, el, parent):
         return self.block(el, parent, nodes.tip)
+    @stack_safe
     def e_warning(self, el, parent):
         return self.block(el, parent, nodes.warning)
 
     e_informalexample = concat
 
+    @stack_safe
     def e_literallayout(self, el, parent):
         return self.concat(el, parent, nodes.literal_block)
 
@@ -401,56 +900,64 @@ class DocbookConverter(object):
 
     # lists
 
+    @stack_safe
     def e_glosslist(self, el, parent):
         self.supports_only(el, (self._ns + "glossentry"))
         self.block(el, parent, nodes.definition_list)
 
+    @stack_safe
     def e_glossentry(self, el, parent):
         self.supports_only(el, (self._ns + "glossterm",
                                  self._ns + "glossdef"))
         self.block(el, parent, nodes.definition_list_item)
 
+    @stack_safe
     def e_glossterm(self, el, parent):
         self.block(el, parent, nodes.term)
 
+    @stack_safe
     def e_glossdef(self, el, parent):
         self.block(el, parent, nodes.definition)
 
+    @stack_safe
     def e_itemizedlist(self, el, parent):
         self.supports_only(el, (self._ns + "listitem"))
 
         # Texinfo does not use Mark, instead it places the bullet at the
-        # beginning of each listitem.  Recover it, and make self._text
+        # beginning of each listitem.  Recover it, and make each listitem
         # strip it later.
         item = el.find(self._ns + "listitem[1]/" + self._ns + "para[1]")
         if item is not None and item.text[1] == ' ':
             bullet = item.text[0]
-            self._listitem_mangle_fn = lambda s: s[1:].lstrip()
+            self._listitem_rule = 'strip_bullet'
         else:
             bullet = 'bullet'
 
         node = self.block(el, parent, nodes.bullet_list)
         node['bullet'] = bullet
 
-        # the function can be overwritten - listitem saves/restores it for us
-        self._listitem_mangle_fn = None
+        # the rule can be overwritten - listitem saves/restores it for us
+        self.defer(setattr, self, '_listitem_rule', None)
 
+    @stack_safe
     def e_orderedlist(self, el, parent):
         self.supports_only(el, (self._ns + "listitem"))
+        self.defer(setattr, self, '_ordered_list_depth', self._ordered_list_depth)
         self._ordered_list_depth = self._ordered_list_depth + 1
         node = self.block(el, parent, nodes.enumerated_list)
         node['enumtype'] = 'arabic' if self._ordered_list_depth == 1 else 'loweralpha'
         node['prefix'] = ''
         node['suffix'] = '.'
-        self._ordered_list_depth = self._ordered_list_depth - 1
 
+    @stack_safe
     def e_listitem(self, el, parent):
-        save_listitem_mangle_fn = self._listitem_mangle_fn
-        self._text_mangle_fn = self._listitem_mangle_fn
-        self._listitem_mangle_fn = None
+        self.defer(setattr, self, '_listitem_rule', self._listitem_rule)
+        if self._listitem_rule is not None:
+            self.text_rule(parent, self._listitem_rule)
+        self._listitem_rule = None
         self.block(el, parent, nodes.list_item)
-        self._listitem_mangle_fn = save_listitem_mangle_fn
 
+    @stack_safe
     def e_variablelist(self, el, parent):
         #VariableList ::= ((Title,TitleAbbrev?)?, VarListEntry+)
         self.supports_only(el, (self._ns + "varlistentry"))
@@ -469,25 +976,30 @@ class DocbookConverter(object):
 
     # general inline elements
 
+    @stack_safe
     def e_emphasis(self, el, parent):
         if el.attrib.get('Role', '') == 'strong':
             self.concat(el, parent, nodes.strong)
         else:
             self.concat(el, parent, nodes.emphasis)
 
+    @stack_safe
     def e_phrase(self, el, parent):
         self.concat(el, parent, nodes.emphasis)
     e_citetitle = e_emphasis
     e_replaceable = e_emphasis
 
+    @stack_safe
     def e_literal(self, el, parent):
         self.concat(el, parent, nodes.literal)
     e_code = e_literal
 
+    @stack_safe
     def e_keycap(self, el, parent):
         self.has_only_text(el, parent)
         self.inline(el, parent, 'kbd')
 
+    @stack_safe
     def e_application(self, el, parent):
         self.has_only_text(el, parent)
         self.inline(el, parent, 'program')
@@ -496,54 +1008,70 @@ class DocbookConverter(object):
     e_systemitem = e_literal
     e_prompt = e_literal
 
+    @stack_safe
     def e_filename(self, el, parent):
         self.inline(el, parent, 'file')
 
+    @stack_safe
     def e_command(self, el, parent):
         self.inline(el, parent, 'command')
 
+    @stack_safe
     def e_option(self, el, parent):
         self.inline(el, parent, 'option')
 
+    @stack_safe
     def e_envar(self, el, parent):
         self.inline(el, parent, 'env')
 
     def e_cmdsynopsis(self, el, parent):
         # just remove all markup and remember to change it manually later
         parent += nodes.comment('cmdsynopsis', 'cmdsynopsis')
-        self.no_markup(el, nodes.inline, parent)
+        self.no_markup(el, parent)
 
+    @stack_safe
     def e_firstterm(self, el, parent):
         self.has_only_text(el, parent)
         self.inline(el, parent, 'dfn')
 
+    @stack_safe
     def e_userinput(self, el, parent):
         self.inline(el, parent, 'kbd')
 
+    @stack_safe
     def e_subscript(self, el, parent):
         self.concat(el, parent, nodes.subscript)
 
+    @stack_safe
     def e_superscript(self, el, parent):
         self.concat(el, parent, nodes.superscript)
 
+    @stack_safe
     def e_quote(self, el, parent):
         parent += nodes.Text('\u2018', '\u2018')
         node = self.concat(el, parent)
-        parent += nodes.Text('\u2019', '\u2019')
+        self.defer(parent.append, nodes.Text('\u2019', '\u2019'))
 
+    @stack_safe
     def e_footnote(self, el, parent):
         self.supports_only(el, (self._ns + "para",))
         node = self.node(parent, nodes.footnote_reference)
+        node['auto'] = 1
         node += nodes.Text('#')
         self.document.note_autofootnote_ref(node)
 
         node = self.create(el, parent, nodes.footnote)
+        node['auto'] = 1
         self.concat_into(el, node, False)
+        self.defer(self._close_footnote, node)
+
+    def _close_footnote(self, node):
         self.document.note_autofootnote(node)
         self._save.append(node)
 
     # links
 
+    @stack_safe
     def e_ulink(self, el, parent):
         node = self.concat(el, parent, nodes.reference)
         node['refuri'] = el.get("url")
@@ -557,6 +1085,7 @@ class DocbookConverter(object):
             node['refuri'] = el.get('{http://www.w3.org/1999/xlink}href')
             node += nodes.Text(node['refuri'])
 
+    @stack_safe
     def e_link(self, el, parent):
         node = self.concat(el, parent, nodes.reference)
         if 'linkend' in el.attrib:
@@ -607,18 +1136,19 @@ class DocbookConverter(object):
     # Usually, (inline)equation is
     # a (inline)mediaobject, which is imageobject + textobject
 
+    @stack_safe
     def e_inlineequation(self, el, parent):
         self.supports_only(el, (self._ns + "mathphrase"))
         self.concat(el, parent)
 
+    @stack_safe
     def e_equation(self, el, parent):
         self.supports_only(el, (self._ns + "title",
                                  self._ns + "mathphrase"))
-        save_title_handler = self._title_handler
-        self._title_handler = self.rubric
+        self.set_title_handler(self.rubric)
         self.concat(el, parent)
-        self._title_handler = save_title_handler
 
+    @stack_safe
     def e_mathphrase(self, el, parent):
         if self._stack[-2] == 'inlineequation':
             self.inline(el, parent, 'math', False)
@@ -637,14 +1167,14 @@ class DocbookConverter(object):
     # basic programming elements.  a more sophisticated translation is
     # used when additional Sphinx nodes are available
 
+    @stack_safe
     def e_refentry(self, el, parent):
         self.block(el, parent, nodes.section)
 
+    @stack_safe
     def e_refsect1(self, el, parent):
-        save_title_handler = self._title_handler
-        self._title_handler = self.rubric
+        self.set_title_handler(self.rubric)
         node = self.block(el, parent)
-        self._title_handler = save_title_handler
 
     e_info = nop
     e_refentryinfo = nop
@@ -672,16 +1202,16 @@ class DocbookConverter(object):
             text = ", "
         parent += self.text(")")
 
+    @stack_safe
     def e_funcparams(self, el, parent):
         parent += self.text('(')
-        # collapse extra spaces, they looks very ugly in sphinx output
-        self._text_mangle_fn = lambda x: re.sub(' +', ' ', x)
+        self.text_rule(parent, 'collapse_spaces')
         node = self.concat(el, parent)
-        parent += self.text(')')
+        self.defer(self.append_text, parent, ')')
 
+    @stack_safe
     def e_parameter(self, el, parent):
-        # collapse extra spaces, they looks very ugly in sphinx output
-        self._text_mangle_fn = lambda x: re.sub(' +', ' ', x)
+        self.text_rule(parent, 'collapse_spaces')
         if self._stack[-2] == 'paramdef':
             self.concat(el, parent, nodes.emphasis)
         else:
@@ -713,36 +1243,399 @@ class DocbookParser(docutils.parsers.Parser):
         (('Expect docbook5 namespace',
           ['--ns'],
           {'action': 'store_true'}),
+         ('Convert deeply nested documents without recursion',
+          ['--explicit-stack'],
+          {'action': 'store_true'}),
+         ('Convert large documents one chapter at a time',
+          ['--stream'],
+          {'action': 'store_true'}),
+         ('Allow very deep trees and very long text nodes',
+          ['--huge-tree'],
+          {'action': 'store_true'}),
+         ('Do not replace entities',
+          ['--no-resolve-entities'],
+          {'action': 'store_false', 'dest': 'resolve_entities',
+           'default': True}),
+         ('Allow network access when loading DTDs and entities',
+          ['--network'],
+          {'action': 'store_false', 'dest': 'no_network', 'default': True}),
+         ('Do not build a table of XML ids',
+          ['--no-collect-ids'],
+          {'action': 'store_false', 'dest': 'collect_ids', 'default': True}),
+         ('Discard whitespace-only text between elements',
+          ['--remove-blank-text'],
+          {'action': 'store_true'}),
+         ('Do not process XIncludes',
+          ['--no-xinclude'],
+          {'action': 'store_false', 'dest': 'xinclude', 'default': True}),
+         ('Cache converted documents in this directory',
+          ['--doctree-cache'],
+          {'metavar': '<directory>'}),
+         ('Size limit in bytes for --doctree-cache (default 256 MiB)',
+          ['--doctree-cache-size'],
+          {'metavar': '<bytes>', 'type': 'int', 'default': 256 << 20}),
+         ('Report every warning about unsupported markup ("each", the '
+          'default), or each kind of problem once with a count ("summary")',
+          ['--diagnostics'],
+          {'choices': ['each', 'summary'], 'default': 'each',
+           'metavar': '<mode>'}),
+         ('Replace the pattern and replacement of a text rule, '
+          '"collapse_spaces" (spaces in function parameters) or '
+          '"strip_bullet" (bullets in makeinfo lists); can be repeated',
+          ['--text-rule'],
+          {'nargs': 3, 'action': 'append', 'dest': 'text_rules',
+           'metavar': '<name> <pattern> <replacement>'}),
+         ('Write the time spent on each DocBook element handler to this '
+          'JSON file, and the handler stacks for flame graphs to the same '
+          'name with a .folded extension',
+          ['--profile-handlers'],
+          {'metavar': '<file>'}),
         ))
 
+    # lxml.etree.XMLParser options that come from the settings
+    xml_options = ('huge_tree', 'resolve_entities', 'no_network',
+                   'collect_ids', 'remove_blank_text')
+
+    # settings that can change the result of a conversion
+    cache_settings = ('huge_tree', 'resolve_entities', 'no_network',
+                      'collect_ids', 'remove_blank_text', 'xinclude',
+                      'diagnostics', 'text_rules')
+
+    # attributes of a document that are not part of the cached conversion
+    _uncached_attributes = ('reporter', 'transformer', 'settings',
+                            'document', '_document', 'current_source',
+                            'current_line')
+
     converter = DocbookConverter
 
-    def _parse_xml(self, inputstring):
-        # pass an encoding so that lxml doesn't complain about
-        # an encoding in the XML processing instruction
-        parser = lxml.etree.XMLParser(remove_comments=False, encoding='utf-8')
-        input = BytesIO(inputstring.encode('utf-8'))
-        tree = lxml.etree.parse(input, parser=parser)
-        try:
-            # Python 3
-            root = tree.getroot()
-        except:
-            # Python 2
-            root = tree
+    # included files, shared by all documents parsed in this process
+    fragment_cache = xinclude.FragmentCache()
+
+    # size of the pieces of input fed to lxml
+    chunk_size = 1 << 16
+
+    def _pieces(self, inputstring):
+        """
+        Split `inputstring` in UTF-8 encoded pieces of at most chunk_size
+        bytes.  `inputstring` can also be bytes or an mmap object, as
+        returned by DocbookFileInput, and is then passed through as is.
+        """
+        size = self.chunk_size
+        raw = isinstance(inputstring, (bytes, mmap.mmap))
+        for i in range(0, len(inputstring), size):
+            if raw:
+                yield inputstring[i:i + size]
+            else:
+                yield inputstring[i:i + size].encode('utf-8')
+
+    def get_setting(self, document, name):
+        return getattr(document.settings, name, None)
+
+    def _get_xml_parser(self, klass, inputstring, document, **options):
+        """
+        Return an instance of `klass`, an lxml parser class, for `inputstring`.
+        Parsers are cached per thread, and must be given back with
+        _put_xml_parser once `inputstring` has been parsed successfully.
+        """
+        options['remove_comments'] = False
+        if not isinstance(inputstring, (bytes, mmap.mmap)):
+            # pass an encoding so that lxml doesn't complain about
+            # an encoding in the XML processing instruction
+            options['encoding'] = 'utf-8'
+        for name in self.xml_options:
+            value = self.get_setting(document, name)
+            if value is not None:
+                options[name] = value
+
+        key = (klass, tuple(sorted(options.items())))
+        cache = _xml_parsers.__dict__.setdefault('parsers', {})
+        parser = cache.pop(key, None)
+        if parser is None:
+            parser = klass(**options)
+        return key, parser
+
+    def _put_xml_parser(self, key, parser):
+        _xml_parsers.parsers[key] = parser
+
+    def _parse_xml(self, inputstring, document):
+        key, parser = self._get_xml_parser(lxml.etree.XMLParser,
+                                           inputstring, document)
+        for piece in self._pieces(inputstring):
+            parser.feed(piece)
+        root = parser.close()
+        self._put_xml_parser(key, parser)
+        return root
 
+    def _load_xml(self, path, document):
+        key, parser = self._get_xml_parser(lxml.etree.XMLParser, b'', document)
+        root = lxml.etree.parse(path, parser).getroot()
+        self._put_xml_parser(key, parser)
         return root
 
+    def _set_base(self, root, document):
+        "make relative XIncludes start from the directory of the document"
+        source = document.get('source')
+        if source and os.path.isfile(source):
+            root.getroottree().docinfo.URL = os.path.abspath(source)
+
+    def note_dependency(self, document, path):
+        dependencies = getattr(document.settings, 'record_dependencies', None)
+        if dependencies is not None:
+            dependencies.add(path)
+
+    def resolve_xincludes(self, el, document):
+        """
+        Replace the xi:include elements in the subtree rooted at `el`
+        (including `el` itself) with the content they point to.
+        """
+        if self.get_setting(document, 'xinclude') is False:
+            return
+        resolver = xinclude.XIncludeResolver(
+            self.fragment_cache, lambda path: self._load_xml(path, document),
+            document.reporter)
+        for path in sorted(set(path for path, _ in resolver.resolve(el))):
+            self.note_dependency(document, path)
+            if self._dependencies is not None:
+                self._dependencies.add(path)
+
+    def _iterparse_xml(self, inputstring, document):
+        """Generate lxml parse events for `inputstring`, a piece at a time."""
+        key, parser = self._get_xml_parser(lxml.etree.XMLPullParser,
+                                           inputstring, document,
+                                           events=('start', 'end', 'comment', 'pi'))
+        for piece in self._pieces(inputstring):
+            parser.feed(piece)
+            for event in parser.read_events():
+                yield event
+        parser.close()
+        for event in parser.read_events():
+            yield event
+        self._put_xml_parser(key, parser)
+
     def _get_converter(self, document, root):
         return self.converter(self, document, root.tag[0] == '{')
 
+    # files included while converting the current document
+    _dependencies = None
+
     def parse(self, inputstring, document):
         """Parse `inputstring` and populate `document`, a document tree."""
         self.setup_parse(inputstring, document)
-        root = self._parse_xml(inputstring)
-        self._get_converter(document, root).convert_root(root)
+        cache = self._get_doctree_cache(document)
+        if cache is None:
+            self._convert(inputstring, document)
+        else:
+            key = self._cache_key(cache, inputstring, document)
+            entry = cache.get(key)
+            if entry is not None:
+                self._restore(entry, document)
+            else:
+                self._convert_and_store(cache, key, inputstring, document)
+        self._finish_handler_profile(document)
         self.finish_parse()
 
+    def _convert(self, inputstring, document):
+        if self.get_setting(document, 'stream'):
+            events = self._iterparse_xml(inputstring, document)
+            for event, root in events:
+                if event == 'start':
+                    break
+            self._set_base(root, document)
+            converter = self._get_converter(document, root)
+            converter.convert_events(root, events)
+        else:
+            root = self._parse_xml(inputstring, document)
+            self._set_base(root, document)
+            self.resolve_xincludes(root, document)
+            converter = self._get_converter(document, root)
+            converter.convert_root(root)
+        return converter
+
+    # statistics on the converter, by output file; they accumulate
+    # over all the documents converted by the process, and are written
+    # by save_handler_profiles()
+
+    _handler_profiles = {}
+
+    def _get_handler_profile(self, document):
+        path = self.get_setting(document, 'profile_handlers')
+        if not path:
+            return None
+        profile = self._handler_profiles.get(path)
+        if profile is None:
+            profile = _import_profiling().HandlerProfile()
+            self._handler_profiles[path] = profile
+        return profile
+
+    def _finish_handler_profile(self, document):
+        path = self.get_setting(document, 'profile_handlers')
+        profile = self._handler_profiles.get(path) if path else None
+        if profile is not None:
+            profile.finish_document()
+
+    @classmethod
+    def take_handler_profiles(cls):
+        "return the statistics collected so far, and start again"
+        profiles = dict(cls._handler_profiles)
+        cls._handler_profiles.clear()
+        return profiles
+
+    @classmethod
+    def merge_handler_profiles(cls, profiles):
+        "add statistics returned by take_handler_profiles() in another process"
+        for path, profile in profiles.items():
+            mine = cls._handler_profiles.get(path)
+            if mine is None:
+                cls._handler_profiles[path] = profile
+            else:
+                mine.merge(profile)
+
+    @classmethod
+    def save_handler_profiles(cls):
+        for path, profile in cls._handler_profiles.items():
+            profile.save(path)
+
+    # persistent cache of converted documents
+
+    _doctree_caches = {}
+
+    def _get_doctree_cache(self, document):
+        directory = self.get_setting(document, 'doctree_cache')
+        if not directory:
+            return None
+        max_size = self.get_setting(document, 'doctree_cache_size')
+        cache = self._doctree_caches.get(directory)
+        if cache is None:
+            cache = _import_doctreecache().DoctreeCache(directory, max_size)
+            self._doctree_caches[directory] = cache
+        return cache
+
+    def _cache_key(self, cache, inputstring, document):
+        import hashlib
+        doctreecache = _import_doctreecache()
+        if not isinstance(inputstring, (bytes, mmap.mmap)):
+            inputstring = inputstring.encode('utf-8')
+        settings = [(name, self.get_setting(document, name))
+                    for name in self.cache_settings]
+        # relative XIncludes and entities depend on where the file is
+        source = document.get('source')
+        if source and os.path.isfile(source):
+            directory = os.path.dirname(os.path.abspath(source))
+        else:
+            directory = None
+        return cache.key(hashlib.sha256(inputstring).hexdigest(), directory,
+                         self.converter.__module__, self.converter.__name__,
+                         doctreecache.code_fingerprint(self.converter,
+                                                       xinclude),
+                         self._library_versions(), settings)
+
+    def _library_versions(self):
+        "versions of what can change the conversion or the pickled nodes"
+        return (docutils.__version__, lxml.etree.LXML_VERSION,
+                sys.version_info[:2])
+
+    def _convert_and_store(self, cache, key, inputstring, document):
+        import pickle
+        doctreecache = _import_doctreecache()
+        messages = []
+        document.reporter.attach_observer(messages.append)
+        self._dependencies = set()
+        try:
+            converter = self._convert(inputstring, document)
+        finally:
+            document.reporter.detach_observer(messages.append)
+            dependencies, self._dependencies = self._dependencies, None
+        if not converter.cacheable:
+            return
+
+        entry = {}
+        try:
+            entry['dependencies'] = [(path, doctreecache.file_digest(path))
+                                     for path in sorted(dependencies)]
+        except EnvironmentError:
+            return
+        entry['messages'] = [(msg['level'], msg.children[0].astext(),
+                              msg.get('line')) for msg in messages
+                             if msg.children]
+        saved = [(name, document.__dict__[name])
+                 for name in self._uncached_attributes
+                 if name in document.__dict__]
+        try:
+            for name, _ in saved:
+                setattr(document, name, None)
+            try:
+                entry['document'] = pickle.dumps(document,
+                                                 pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                return
+        finally:
+            for name, value in saved:
+                setattr(document, name, value)
+        cache.put(key, entry)
+
+    def _restore(self, entry, document):
+        import pickle
+        # report the messages again; if the document keeps track of them,
+        # the copies are overwritten below with those from the cache
+        for level, message, line in entry['messages']:
+            document.reporter.system_message(level, message, line=line)
+
+        cached = pickle.loads(entry['document'])
+        source = document.get('source')
+        for name, value in cached.__dict__.items():
+            if name not in self._uncached_attributes:
+                setattr(document, name, value)
+        document['source'] = source
+
+        # the nodes still point to the unpickled document
+        stack = list(document.children)
+        for node in stack:
+            node.parent = document
+        while stack:
+            node = stack.pop()
+            node.document = document
+            stack.extend(getattr(node, 'children', ()))
+
+        for path, _ in entry['dependencies']:
+            self.note_dependency(document, path)
+
     def nested_parse(self, inputstring, state, parent):
         """Parse `inputstring` and populate `document`, a document tree."""
-        root = self._parse_xml(inputstring)
-        self._get_converter(state.memo.document, root).nested_convert(root, parent)
+        document = state.memo.document
+        root = self._parse_xml(inputstring, document)
+        self._set_base(root, document)
+        self.resolve_xincludes(root, document)
+        self._get_converter(document, root).nested_convert(root, parent)
+
+
+class DocbookFileInput(docutils.io.FileInput):
+    '''
+    Input for DocBook files that leaves decoding to lxml, so that the
+    encoding in the XML declaration is honored.  Regular files are
+    memory-mapped instead of being read into a string.
+    '''
+
+    def read(self):
+        try:
+            if self.source is sys.stdin:
+                return getattr(sys.stdin, 'buffer', sys.stdin).read()
+            with open(self.source_path, 'rb') as f:
+                try:
+                    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, EnvironmentError):
+                    # empty files and pipes cannot be mapped
+                    return f.read()
+        finally:
+            if self.autoclose:
+                self.close()
+
+class DocbookStringInput(docutils.io.StringInput):
+    '''
+    Input for DocBook documents in memory.  Like DocbookFileInput, it
+    passes bytes through, so that lxml decodes them.
+    '''
+
+    def read(self):
+        if isinstance(self.source, bytes):
+            return self.source
+        return docutils.io.StringInput.read(self)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+    On-disk cache of converted documents
+    ====================================
+    Entries are keyed by a hash of the DocBook source and of everything
+    else that affects the conversion, including the directory of the
+    source because of relative XIncludes.  The cache directory can be
+    shared between runs and between builds of the same tree.  When the
+    directory grows above its size limit, the least recently used
+    entries are removed.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+
+_replace = getattr(os, 'replace', os.rename)
+
+_fingerprints = {}
+
+def code_fingerprint(klass, *modules):
+    """
+    Return a hash of the source code of the modules that define klass
+    and its base classes, and of `modules`, so that entries are not
+    reused after the converter changes.
+    """
+    try:
+        return _fingerprints[(klass,) + modules]
+    except KeyError:
+        pass
+    h = hashlib.sha1()
+    for module in [sys.modules.get(base.__module__)
+                   for base in klass.__mro__] + list(modules):
+        filename = getattr(module, '__file__', None)
+        if filename is None:
+            continue
+        if filename.endswith(('.pyc', '.pyo')):
+            filename = filename[:-1]
+        h.update(module.__name__.encode('utf-8'))
+        try:
+            with open(filename, 'rb') as f:
+                h.update(f.read())
+        except EnvironmentError:
+            h.update(getattr(module, '__version__', '').encode('utf-8'))
+    _fingerprints[(klass,) + modules] = result = h.hexdigest()
+    return result
+
+def file_digest(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+class DoctreeCache(object):
+    '''
+    A directory of pickled entries.  Each entry is a dictionary; its
+    'dependencies' item, if present, is a list of (filename, digest)
+    tuples that must still match for the entry to be used.
+    '''
+
+    suffix = '.pickle'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+
+    def key(self, *parts):
+        h = hashlib.sha256()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = repr(part).encode('utf-8')
+            h.update(hashlib.sha256(part).digest())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + self.suffix)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            for filename, digest in entry.get('dependencies', ()):
+                if file_digest(filename) != digest:
+                    return None
+            # the modification time orders entries for eviction
+            os.utime(path, None)
+        except EnvironmentError:
+            return None
+        except Exception:
+            # truncated or written by an incompatible version
+            self._remove(path)
+            return None
+        return entry
+
+    def put(self, key, entry):
+        try:
+            data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # some nodes cannot be pickled; just do not cache them
+            return False
+        if len(data) > self.max_size:
+            return False
+
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            _replace(tmp, path)
+        except EnvironmentError:
+            return False
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += len(data)
+        if self._size > self.max_size:
+            self.evict()
+        return True
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(self.suffix):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except EnvironmentError:
+                        continue
+                    yield st.st_mtime, st.st_size, path
+
+    def evict(self):
+        "remove the oldest entries until the cache is 10% below its limit"
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        target = self.max_size * 9 // 10
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            if self._remove(path):
+                size -= entry_size
+        self._size = size
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+            return True
+        except EnvironmentError:
+            return False
@@ -9,39 +9,222 @@
     :license: MIT.
 """
 
+import json
 import lxml.etree
 import dbparser
+import os
 import sphinx.parsers
+import time
 import traceback
 
 from os import path
 from docutils import nodes
 from sphinx import addnodes
-from collections import defaultdict
-from recommonmark.states import DummyStateMachine
+from sphinx.util import logging
+from collections import defaultdict, OrderedDict
 
 __version__ = '0.0.1'
 __contributors__ = ('Paolo Bonzini <pbonzini@redhat.com>')
 
+logger = logging.getLogger(__name__)
+
+_clock = getattr(time, 'perf_counter', time.time)
+
 class resource_placeholder(nodes.General, nodes.Element):
     pass
 
+def _unshare(tree):
+    '''
+    Make the nodes of tree look like a deepcopy() of it before they are
+    moved elsewhere: an element that appears more than once (footnotes
+    are added both to their paragraph and after it) is replaced by a
+    copy where it appears again, and every element points to its parent.
+    Otherwise a writer would visit the same node twice, and see the
+    classes that it added the first time.
+    '''
+    seen = set()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        for i, child in enumerate(node.children):
+            if not isinstance(child, nodes.Element):
+                continue
+            if id(child) in seen:
+                child = node.children[i] = child.deepcopy()
+            seen.add(id(child))
+            child.parent = node
+            stack.append(child)
+
+def _count_nodes(node):
+    "the number of nodes in the subtree rooted at node"
+    # findall() replaces traverse() in docutils 0.18
+    findall = getattr(node, 'findall', None)
+    if findall is None:
+        return len(node.traverse())
+    return sum(1 for _ in findall())
+
+class ResolvedDoctreeCache(object):
+    '''
+    Doctrees of the resources, with references already resolved, for use
+    by replace_placeholders.  When the total size of the pickled doctrees
+    goes above max_size bytes, the least recently used ones are dropped.
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, builder, docname, usage=None):
+        entry = self._entries.pop(docname, None)
+        if entry is None:
+            env = builder.env
+            start = _clock()
+            doctree = env.get_doctree(docname)
+            loaded = _clock()
+            env.resolve_references(doctree, docname, builder)
+            if usage is not None:
+                usage['doctrees_loaded'] += 1
+                usage['get_doctree_seconds'] += loaded - start
+                usage['resolve_references_seconds'] += _clock() - loaded
+            try:
+                size = path.getsize(path.join(env.doctreedir,
+                                              docname + '.doctree'))
+            except EnvironmentError:
+                size = 0
+            entry = (doctree, size)
+            self.size += size
+        self._entries[docname] = entry
+        while self.size > self.max_size and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.size -= size
+        return entry[0]
+
+    def discard(self, docname):
+        entry = self._entries.pop(docname, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def __contains__(self, docname):
+        return docname in self._entries
+
+class AssemblyReport(object):
+    '''
+    What the assembly machinery did during a build, for
+    docbook_assembly_report: for each document with placeholders, how
+    many were expanded, the doctrees that had to be loaded and resolved
+    for them, the nodes copied or moved into the document, and the time
+    all of this took.
+    '''
+
+    COUNTERS = ('placeholders', 'doctrees_loaded', 'nodes_copied',
+                'nodes_moved', 'get_doctree_seconds',
+                'resolve_references_seconds', 'seconds')
+
+    def __init__(self):
+        self.documents = {}
+        self.title_from_top_resource_seconds = 0.0
+        self.write_start = None
+        self.write_seconds = None
+
+    def document(self, docname):
+        usage = self.documents.get(docname)
+        if usage is None:
+            usage = self.documents[docname] = dict.fromkeys(self.COUNTERS, 0)
+        return usage
+
+    def as_dict(self):
+        return {'documents': self.documents,
+                'expansion_seconds': sum(x['seconds']
+                                         for x in self.documents.values()),
+                'title_from_top_resource_seconds':
+                    self.title_from_top_resource_seconds,
+                'write_seconds': self.write_seconds}
+
+    def format(self):
+        "return the lines of a summary table"
+        lines = ['%-30s %12s %7s %9s %9s %9s' % ('document', 'placeholders',
+                 'loaded', 'nodes', 'resolve s', 'total s')]
+        for docname, x in sorted(self.documents.items(),
+                                 key=lambda item: item[1]['seconds'],
+                                 reverse=True):
+            lines.append('%-30s %12d %7d %9d %9.3f %9.3f'
+                         % (docname, x['placeholders'], x['doctrees_loaded'],
+                            x['nodes_copied'] + x['nodes_moved'],
+                            x['resolve_references_seconds'], x['seconds']))
+        return lines
+
 class DocbookAssemblyInfo(object):
+    # ResolvedDoctreeCache for the current build, and number of
+    # placeholders that still have to be replaced for each resource
+    resolved = None
+    pending = None
+
+    # documents that the builder writes in the current build, see
+    # note_written_docs; None if it did not say
+    writing = None
+
+    # AssemblyReport for the current build, if docbook_assembly_report
+    # is set
+    report = None
+
+    # assemblies read by read_assemblies_first in the current build
+    read_first = ()
+
+    # Everything is recorded together with the document that was being
+    # read, so that it can be purged and merged one document at a time.
+    #
+    # children: parent -> [(description, child, docname)]
+    # parents: child -> set of parents, the reverse of children
+    # recorded: docname -> set of parents that docname added children to
+    # assemblies: docname -> topmost resource of the assembly
+    # roots: topmost resources of all assemblies
+    # placeholders: docname -> [resource embedded by docname]
+    # embedded_by: resource -> set of documents that embed it
+
+    # bump whenever the attributes below change
+    VERSION = 2
+
     def __init__(self):
+        self.version = self.VERSION
         self.children = defaultdict(list)
+        self.parents = defaultdict(set)
+        self.recorded = defaultdict(set)
         self.assemblies = {}
         self.roots = set()
+        self.placeholders = defaultdict(list)
+        self.embedded_by = defaultdict(set)
+
+    def __getstate__(self):
+        # resolved doctrees are only valid for the current build
+        state = self.__dict__.copy()
+        state.pop('resolved', None)
+        state.pop('pending', None)
+        state.pop('writing', None)
+        state.pop('read_first', None)
+        return state
 
     # callbacks from SphinxDocbookConverter
 
-    def add_child(self, parent, child, description):
-        self.children[parent].append((description, child))
+    def add_child(self, docname, parent, child, description):
+        self.children[parent].append((description, child, docname))
+        self.parents[child].add(parent)
+        self.recorded[docname].add(parent)
+
+    def add_assembly(self, docname, top):
+        self.assemblies[docname] = top
+        self.roots.add(top)
+
+    def add_placeholder(self, docname, resource):
+        self.placeholders[docname].append(resource)
+        self.embedded_by[resource].add(docname)
 
     def create_toctree(self, app, doctree, docname):
+        "add a toctree for the children of docname; return True if it did"
         if (docname in self.roots) or (not docname in self.children):
-            return
+            return False
         env = app.builder.env
-        children = self.children[docname]
+        children = [x[:2] for x in self.children[docname]]
         tocnode = addnodes.toctree()
         tocnode['entries'] = children
         tocnode['includefiles'] = [x[1] for x in children]
@@ -50,33 +233,114 @@ class DocbookAssemblyInfo(object):
         wrapper = nodes.compound(classes=['toctree-wrapper'])
         wrapper += tocnode
         doctree += wrapper
+        return True
 
     # Sphinx event callbacks
 
     def title_from_top_resource(self, app, env):
+        start = _clock()
         for docname, top in self.assemblies.items():
             env.titles[docname] = env.titles[top]
             env.longtitles[docname] = env.longtitles[top]
+        if self.report is not None:
+            self.report.title_from_top_resource_seconds += _clock() - start
 
     def replace_placeholders(self, app, doctree, docname):
-        builder = app.builder
-        env = builder.env
+        if self.resolved is None:
+            self.resolved = ResolvedDoctreeCache(
+                app.config.docbook_resource_cache_size)
+            self.pending = defaultdict(int)
+            # in incremental builds, most documents are not written and
+            # would never use their share of the resources
+            writing = self.placeholders if self.writing is None else self.writing
+            for written in writing:
+                for resource in self.placeholders.get(written, ()):
+                    self.pending[resource] += 1
+
+        usage = None
+        if self.report is not None and docname in self.placeholders:
+            usage = self.report.document(docname)
+            start = _clock()
         for placeholder in doctree.traverse(resource_placeholder):
-            target_doctree = env.get_doctree(placeholder.docname)
-            env.resolve_references(target_doctree, placeholder.docname, builder)
+            resource = placeholder.docname
+            target_doctree = self.resolved.get(app.builder, resource, usage)
+            self.pending[resource] -= 1
+            if self.pending[resource] <= 0:
+                self.resolved.discard(resource)
 
             root = nodes.compound()
-            for node in target_doctree.children:
-                root += node.deepcopy()
-
+            copied = resource in self.resolved
+            if copied:
+                for node in target_doctree.children:
+                    root += node.deepcopy()
+            else:
+                # nobody else will use this doctree, move the nodes
+                _unshare(target_doctree)
+                root.extend(target_doctree.children)
+                target_doctree.children = []
+
+            if usage is not None:
+                # counting is not part of the expansion time
+                paused = _clock()
+                usage['placeholders'] += 1
+                count = _count_nodes(root) - 1
+                usage['nodes_copied' if copied else 'nodes_moved'] += count
+                start += _clock() - paused
             placeholder.replace_self(root.children)
+        if usage is not None:
+            usage['seconds'] += _clock() - start
+
+    def get_outdated(self, docnames):
+        "return the documents that embed any of docnames"
+        outdated = set()
+        for docname in docnames:
+            outdated.update(self.embedded_by.get(docname, ()))
+        return outdated
 
     def purge(self, env, docname):
+        for resource in self.placeholders.pop(docname, ()):
+            self.embedded_by[resource].discard(docname)
+            if not self.embedded_by[resource]:
+                del self.embedded_by[resource]
         if docname in self.assemblies:
-            self.roots.remove(self.assemblies[docname])
             del self.assemblies[docname]
-        for key in self.children.keys():
-            self.children[key] = [x for x in self.children[key] if x[1] != docname]
+            self.roots = set(self.assemblies.values())
+        for parent in self.recorded.pop(docname, ()):
+            self._remove_children(parent, lambda x: x[2] == docname)
+        if docname not in env.found_docs:
+            # the document was removed, drop the links to it
+            for parent in list(self.parents.get(docname, ())):
+                self._remove_children(parent, lambda x: x[1] == docname)
+
+    def _remove_children(self, parent, predicate):
+        kept = []
+        removed = set()
+        for x in self.children.get(parent, ()):
+            if predicate(x):
+                removed.add(x[1])
+            else:
+                kept.append(x)
+        if kept:
+            self.children[parent] = kept
+        else:
+            self.children.pop(parent, None)
+
+        removed.difference_update(x[1] for x in kept)
+        for child in removed:
+            self.parents[child].discard(parent)
+            if not self.parents[child]:
+                del self.parents[child]
+
+    def merge(self, other, docnames):
+        for docname in docnames:
+            for parent in other.recorded.get(docname, ()):
+                for description, child, owner in other.children[parent]:
+                    if owner == docname:
+                        self.add_child(docname, parent, child, description)
+            if docname in other.assemblies:
+                self.add_assembly(docname, other.assemblies[docname])
+            for resource in other.placeholders.get(docname, ()):
+                self.add_placeholder(docname, resource)
 
 
 class SphinxDocbookConverter(dbparser.DocbookConverter):
@@ -112,13 +376,28 @@ class SphinxDocbookConverter(dbparser.DocbookConverter):
     def convert_root(self, el):
         self.current_docname = self.env.docname
         super(SphinxDocbookConverter, self).convert_root(el)
+        self._finish_root()
+
+    def convert_events(self, root, events):
+        self.current_docname = self.env.docname
+        super(SphinxDocbookConverter, self).convert_events(root, events)
+        self._finish_root()
+
+    def _finish_root(self):
         self.current_docname = None
         if hasattr(self.env, 'docbook_assembly_info'):
-            self.env.docbook_assembly_info.create_toctree(
-                    self.app, self.document, self.env.docname)
+            if self.env.docbook_assembly_info.create_toctree(
+                    self.app, self.document, self.env.docname):
+                # the toctree depends on the assemblies, not on the source
+                self.cacheable = False
 
     def _run_directive(self, parent, name, arguments=None, options=None,
                        content=None):
+        # recommonmark is only needed by documents that use rst roles
+        # and directives, so it is not loaded together with the extension
+        from recommonmark.states import DummyStateMachine
+        # directives can store information in the environment
+        self.cacheable = False
         state_machine = DummyStateMachine()
         state_machine.reset(self.document, parent, self.current_level)
         if not content is None:
@@ -127,6 +406,8 @@ class SphinxDocbookConverter(dbparser.DocbookConverter):
                                               options=options, content=content)
 
     def _run_role(self, parent, name, options=None, content=None):
+        from recommonmark.states import DummyStateMachine
+        self.cacheable = False
         state_machine = DummyStateMachine()
         state_machine.reset(self.document, parent, self.current_level)
         parent += state_machine.run_role(name, options=options, content=content)
@@ -171,7 +452,9 @@ class SphinxDocbookConverter(dbparser.DocbookConverter):
 
     # assembly -> toctree conversion
 
+    @dbparser.stack_safe
     def e_assembly(self, el, parent):
+        self.cacheable = False
         if not hasattr(self.env, 'docbook_assembly_info'):
             self.env.docbook_assembly_info = DocbookAssemblyInfo()
         xml_id = el.get(self._id_attrib) or None
@@ -180,6 +463,7 @@ class SphinxDocbookConverter(dbparser.DocbookConverter):
             self.document.set_id(parent)
         self.visit_children(el, parent)
 
+    @dbparser.stack_safe
     def e_resources(self, el, parent):
         self.resource_base = \
             el.get('{http://www.w3.org/XML/1998/namespace}base', '')
@@ -223,14 +507,17 @@ class SphinxDocbookConverter(dbparser.DocbookConverter):
 
         docname = self.current_docname
         if self.current_depth == 1:
-            self.env.docbook_assembly_info.assemblies[self.parent_docname] = docname
-            self.env.docbook_assembly_info.roots.add(docname)
+            self.env.docbook_assembly_info.add_assembly(self.parent_docname,
+                                                        docname)
 
         placeholder = resource_placeholder()
         placeholder['ids'] = [resourceref]
         placeholder.docname = docname
         parent += placeholder
+        self.env.docbook_assembly_info.add_placeholder(self.env.docname,
+                                                       docname)
 
+    @dbparser.stack_safe
     def e_structure(self, el, parent):
         resourceref = el.get('resourceref')
 
@@ -253,6 +540,9 @@ class SphinxDocbookConverter(dbparser.DocbookConverter):
         parent += wrapper
 
         self.visit_children(el, parent)
+        self.defer(self._close_structure, tocnode, toclist, state)
+
+    def _close_structure(self, tocnode, toclist, state):
         for resourceref in self.modules:
             if resourceref in self.descriptions:
                 # Add a reference to the bullet list
@@ -274,34 +564,40 @@ class SphinxDocbookConverter(dbparser.DocbookConverter):
 
         self.pop_module(state)
 
+    @dbparser.stack_safe
     def e_module(self, el, parent):
         resourceref = el.get('resourceref')
 
         state = self.push_module(resourceref)
         if resourceref in self.descriptions:
             description = self.descriptions[resourceref]
-            self.env.docbook_assembly_info.add_child(self.parent_docname,
+            self.env.docbook_assembly_info.add_child(self.env.docname,
+                                                     self.parent_docname,
                                                      self.current_docname,
                                                      description)
 
         if self.current_depth <= 2:
             self.include_resource(parent)
         self.visit_children(el, parent)
-        self.pop_module(state)
+        self.defer(self.pop_module, state)
 
     e_output = dbparser.DocbookConverter.nop
 
 
     # additional nodes
 
+    @dbparser.stack_safe
     def e_acronym(self, el, parent):
         self.concat(el, parent, addnodes.abbreviations)
 
     # API documentation
 
+    @dbparser.stack_safe
     def e_refentry(self, el, parent):
         self.concat(el, parent)
+        self.defer(self._close_refentry)
 
+    def _close_refentry(self):
         # if the nice header was not built based on the prototype,
         # do it from the refname text
         if len(self._refname_node.children) == 0:
@@ -315,6 +611,7 @@ class SphinxDocbookConverter(dbparser.DocbookConverter):
         self._refname_node = None
         self._refname_parts = None
 
+    @dbparser.stack_safe
     def e_refnamediv(self, el, parent):
         node = self.create(el, parent, addnodes.desc)
         node['noindex'] = False
@@ -331,9 +628,11 @@ class SphinxDocbookConverter(dbparser.DocbookConverter):
         self._refnamediv_node['ids'].append('c.' + self._refname_parts[-1])
         self._refname_node = node
 
+    @dbparser.stack_safe
     def e_refpurpose(self, el, parent):
         self.concat(el, parent, addnodes.desc_content)
 
+    @dbparser.stack_safe
     def e_refsynopsisdiv(self, el, parent):
         self.supports_only(el, (self._ns + "title",
                                  self._ns + "funcsynopsis",
@@ -369,6 +668,7 @@ class SphinxDocbookConverter(dbparser.DocbookConverter):
         for paramdef in paramdefs:
             self._conv(paramdef, desc_parameterlist)
 
+    @dbparser.stack_safe
     def e_paramdef(self, el, parent):
         self.supports_only(el, (self._ns + "parameter",
                                  self._ns + "funcparams"))
@@ -383,6 +683,60 @@ class SphinxDocbookParser(dbparser.DocbookParser, sphinx.parsers.Parser):
 
     converter = SphinxDocbookConverter
 
+    # a memusage.MemoryMeter if docbook_memory_report is set
+    memory_meter = None
+
+    def get_setting(self, document, name):
+        return getattr(self.config, 'docbook_' + name)
+
+    def _library_versions(self):
+        # the doctrees contain Sphinx nodes
+        return (dbparser.DocbookParser._library_versions(self)
+                + (sphinx.__version__,))
+
+    def _get_handler_profile(self, document):
+        if not self.config.docbook_profile_handlers:
+            return None
+        owner, profile = getattr(self.env, 'docbook_handler_profile',
+                                 (None, None))
+        if owner != os.getpid():
+            # a parallel reader; merge_handler_profile adds what it
+            # collects to the statistics of the main process
+            profile = dbparser._import_profiling().HandlerProfile()
+            self.env.docbook_handler_profile = (os.getpid(), profile)
+        return profile
+
+    def _finish_handler_profile(self, document):
+        if self.config.docbook_profile_handlers:
+            owner, profile = getattr(self.env, 'docbook_handler_profile',
+                                     (None, None))
+            if owner == os.getpid():
+                profile.finish_document()
+
+    def _memory_usage(self):
+        return self.env.docbook_memory_usage.setdefault(self.env.docname, {})
+
+    def _parse_xml(self, inputstring, document):
+        if self.memory_meter is None:
+            return dbparser.DocbookParser._parse_xml(self, inputstring, document)
+        with self.memory_meter.measure(self._memory_usage(), 'parse'):
+            return dbparser.DocbookParser._parse_xml(self, inputstring, document)
+
+    def _convert(self, inputstring, document):
+        if self.memory_meter is None:
+            return dbparser.DocbookParser._convert(self, inputstring, document)
+        with self.memory_meter.measure(self._memory_usage(), 'convert'):
+            return dbparser.DocbookParser._convert(self, inputstring, document)
+
+    def note_dependency(self, document, path):
+        self.env.note_dependency(path)
+
+    def _restore(self, entry, document):
+        dbparser.DocbookParser._restore(self, entry, document)
+        if hasattr(self.env, 'docbook_assembly_info'):
+            self.env.docbook_assembly_info.create_toctree(
+                    self.app, document, self.env.docname)
+
     def nested_parse(self, inputstring, state, parent):
         self.env = state.memo.document.settings.env
         self.app = self.env.app
@@ -393,20 +747,218 @@ def purge_assembly_structure(app, env, docname):
     if hasattr(env, 'docbook_assembly_info'):
         env.docbook_assembly_info.purge(env, docname)
 
+def get_outdated_assemblies(app, env, added, changed, removed):
+    # placeholders are filled in when writing, but the assemblies are
+    # reread too, so that they notice resources that were removed
+    info = getattr(env, 'docbook_assembly_info', None)
+    if info is None:
+        return ()
+    if getattr(info, 'version', None) != DocbookAssemblyInfo.VERSION:
+        # saved by an older version of the extension; start afresh
+        del env.docbook_assembly_info
+        return env.found_docs
+    return info.get_outdated(added | changed | removed)
+
+def merge_assembly_structure(app, env, docnames, other):
+    if hasattr(other, 'docbook_assembly_info'):
+        if not hasattr(env, 'docbook_assembly_info'):
+            env.docbook_assembly_info = DocbookAssemblyInfo()
+        env.docbook_assembly_info.merge(other.docbook_assembly_info, docnames)
+
+def is_assembly(filename):
+    if not filename.endswith('.xml'):
+        return False
+    try:
+        for _, el in lxml.etree.iterparse(filename, events=('start',)):
+            return el.tag in ('assembly', '{http://docbook.org/ns/docbook}assembly')
+    except (EnvironmentError, lxml.etree.XMLSyntaxError):
+        pass
+    return False
+
+def read_assemblies_first(app, env, docnames):
+    # Resources get their toctree from the assemblies that refer to them,
+    # so read the assemblies before everything else, and before Sphinx
+    # forks the parallel readers.
+    assemblies = [x for x in docnames if is_assembly(env.doc2path(x))]
+    for docname in assemblies:
+        docnames.remove(docname)
+        app.emit('env-purge-doc', env, docname)
+        env.clear_doc(docname)
+        env.read_doc(docname, app)
+    if assemblies:
+        env.docbook_assembly_info.read_first = assemblies
+
 def process_assemblies_doctrees(app, doctree, docname):
+    # Sphinx emits doctree-resolved in the main process, before handing
+    # the doctree to a writer; the resource doctrees are loaded and
+    # spliced here, so that workers only ever see complete doctrees and
+    # the ResolvedDoctreeCache is never shared between processes.
     env = app.builder.env
     if hasattr(env, 'docbook_assembly_info'):
-        env.docbook_assembly_info.replace_placeholders(app, doctree, docname)
+        meter = SphinxDocbookParser.memory_meter
+        if meter is None:
+            env.docbook_assembly_info.replace_placeholders(app, doctree, docname)
+            return
+        usage = env.docbook_memory_usage.setdefault(docname, {})
+        with meter.measure(usage, 'expand'):
+            env.docbook_assembly_info.replace_placeholders(app, doctree, docname)
+
+def note_written_docs(app):
+    # no event tells which documents the builder writes, but it always
+    # passes them to prepare_writing
+    prepare_writing = app.builder.prepare_writing
+
+    def wrapper(docnames):
+        info = getattr(app.builder.env, 'docbook_assembly_info', None)
+        if info is not None:
+            info.writing = set(docnames)
+        return prepare_writing(docnames)
+    app.builder.prepare_writing = wrapper
 
 def process_assemblies_env(app, env):
+    if DocbookAssemblyInfo.report is not None:
+        # the end of reading
+        DocbookAssemblyInfo.report.write_start = _clock()
+    if hasattr(env, 'docbook_assembly_info'):
+        info = env.docbook_assembly_info
+        info.resolved = None
+        info.pending = None
+        info.title_from_top_resource(app, env)
+        # they were taken out of the list of documents to write
+        read_first, info.read_first = info.read_first, ()
+        return read_first
+
+def create_fragment_cache(app):
+    # parse each included file once per build
+    SphinxDocbookParser.fragment_cache = dbparser.xinclude.FragmentCache()
+
+def clear_build_caches(app, exception):
+    SphinxDocbookParser.fragment_cache.clear()
+    env = app.builder.env
     if hasattr(env, 'docbook_assembly_info'):
-        env.docbook_assembly_info.title_from_top_resource(app, env)
+        env.docbook_assembly_info.resolved = None
+        env.docbook_assembly_info.pending = None
+        env.docbook_assembly_info.writing = None
+
+def start_memory_report(app):
+    if not app.config.docbook_memory_report:
+        return
+    import memusage
+    if not memusage.available():
+        logger.warning('docbook_memory_report needs Python 3.9 or newer')
+        return
+    SphinxDocbookParser.memory_meter = memusage.MemoryMeter()
+    SphinxDocbookParser.memory_meter.start()
+    # only the documents that this build reads and writes
+    app.builder.env.docbook_memory_usage = {}
+
+def merge_memory_usage(app, env, docnames, other):
+    if hasattr(other, 'docbook_memory_usage'):
+        usage = env.__dict__.setdefault('docbook_memory_usage', {})
+        usage.update((docname, other.docbook_memory_usage[docname])
+                     for docname in docnames
+                     if docname in other.docbook_memory_usage)
+
+def report_memory_usage(app, exception):
+    meter = SphinxDocbookParser.memory_meter
+    if meter is None:
+        return
+    import memusage
+    SphinxDocbookParser.memory_meter = None
+    meter.stop()
+    usage = getattr(app.builder.env, 'docbook_memory_usage', None)
+    if exception is not None or not usage:
+        return
+    logger.info('peak memory of the %d documents that used the most '
+                '(traced by tracemalloc, and growth of the process RSS):'
+                % min(len(usage), app.config.docbook_memory_report))
+    for line in memusage.format_report(usage, app.config.docbook_memory_report):
+        logger.info('    ' + line)
+
+def start_handler_profile(app):
+    if app.config.docbook_profile_handlers:
+        profile = dbparser._import_profiling().HandlerProfile()
+        app.builder.env.docbook_handler_profile = (os.getpid(), profile)
+
+def merge_handler_profile(app, env, docnames, other):
+    theirs = getattr(other, 'docbook_handler_profile', None)
+    ours = getattr(env, 'docbook_handler_profile', None)
+    # the reader kept the profile of the main process if it converted
+    # nothing
+    if theirs is not None and ours is not None and theirs[0] != ours[0]:
+        ours[1].merge(theirs[1])
+
+def save_handler_profile(app, env):
+    # once all documents are read, and before the environment is pickled
+    owner, profile = env.__dict__.pop('docbook_handler_profile', (None, None))
+    if profile is not None and profile.documents:
+        profile.save(app.config.docbook_profile_handlers)
+
+def start_assembly_report(app):
+    if app.config.docbook_assembly_report:
+        DocbookAssemblyInfo.report = AssemblyReport()
+
+def write_assembly_report(app, exception):
+    report = DocbookAssemblyInfo.report
+    if report is None:
+        return
+    DocbookAssemblyInfo.report = None
+    if exception is not None:
+        return
+    if report.write_start is not None:
+        report.write_seconds = _clock() - report.write_start
+    data = report.as_dict()
+    with open(app.config.docbook_assembly_report, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.write('\n')
+    if not report.documents:
+        return
+    summary = ('assemblies: %d placeholders expanded in %.3f s'
+               % (sum(x['placeholders'] for x in report.documents.values()),
+                  data['expansion_seconds']))
+    if report.write_seconds:
+        summary += ' (%.0f%% of the writing phase)' % (
+            100.0 * data['expansion_seconds'] / report.write_seconds)
+    logger.info(summary)
+    for line in report.format():
+        logger.info('    ' + line)
 
 def setup(app):
     """Initialize Sphinx extension."""
     app.add_node(resource_placeholder)
+    app.add_config_value('docbook_explicit_stack', False, 'env')
+    app.add_config_value('docbook_stream', False, 'env')
+    app.add_config_value('docbook_huge_tree', False, 'env')
+    app.add_config_value('docbook_resolve_entities', True, 'env')
+    app.add_config_value('docbook_no_network', True, 'env')
+    app.add_config_value('docbook_collect_ids', True, 'env')
+    app.add_config_value('docbook_remove_blank_text', False, 'env')
+    app.add_config_value('docbook_xinclude', True, 'env')
+    app.add_config_value('docbook_diagnostics', 'each', 'env')
+    app.add_config_value('docbook_text_rules', [], 'env')
+    app.add_config_value('docbook_resource_cache_size', 64 * 1024 * 1024, '')
+    app.add_config_value('docbook_doctree_cache', None, '')
+    app.add_config_value('docbook_doctree_cache_size', 256 * 1024 * 1024, '')
+    app.add_config_value('docbook_profile_handlers', None, '')
+    app.add_config_value('docbook_memory_report', 0, '')
+    app.add_config_value('docbook_assembly_report', None, '')
+    app.connect('builder-inited', start_assembly_report)
+    app.connect('build-finished', write_assembly_report)
+    app.connect('builder-inited', start_memory_report)
+    app.connect('builder-inited', start_handler_profile)
+    app.connect('build-finished', report_memory_usage)
+    app.connect('builder-inited', create_fragment_cache)
+    app.connect('builder-inited', note_written_docs)
+    app.connect('build-finished', clear_build_caches)
     app.connect('doctree-resolved', process_assemblies_doctrees)
     app.connect('env-purge-doc', purge_assembly_structure)
+    app.connect('env-merge-info', merge_assembly_structure)
+    app.connect('env-merge-info', merge_memory_usage)
+    app.connect('env-merge-info', merge_handler_profile)
+    app.connect('env-get-outdated', get_outdated_assemblies)
+    app.connect('env-before-read-docs', read_assemblies_first)
     app.connect('env-updated', process_assemblies_env)
+    app.connect('env-updated', save_handler_profile)
     app.add_source_parser('.xml', SphinxDocbookParser)  # needs Sphinx >= 1.4
-    return {'version': __version__, 'parallel_read_safe': False}
+    return {'version': __version__, 'parallel_read_safe': True,
+            'parallel_write_safe': True}
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+    Memory used by each document
+    ============================
+    A MemoryMeter measures how much memory the phases of a build take
+    for each document: parsing, conversion, and the expansion of the
+    resource placeholders of assemblies.
+
+    tracemalloc sees the objects allocated by Python, such as docutils
+    nodes, but not the trees built by lxml, which live in the heap of
+    libxml2.  So each phase also records how much it raised the peak
+    resident set size of the process; that is zero unless the document
+    made the process bigger than it ever was before.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import contextlib
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PHASES = ('parse', 'convert', 'expand')
+
+def available():
+    "True if tracemalloc can measure the peak of a phase (Python 3.9)"
+    return tracemalloc is not None and hasattr(tracemalloc, 'reset_peak')
+
+def _maxrss():
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class MemoryMeter(object):
+    '''
+    Measures phases, which can be nested.  tracemalloc only keeps one
+    peak, so it is reset when a phase starts, and the peak of a phase
+    is folded into the enclosing one when it ends.
+    '''
+
+    def __init__(self):
+        # [traced memory at the start, peak so far, peak RSS at the start]
+        self._frames = []
+        self._started = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+
+    def stop(self):
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    @contextlib.contextmanager
+    def measure(self, usage, phase):
+        """
+        Measure the body of the with statement.  usage maps phases to
+        a list of the traced peak and the growth of the peak RSS, in
+        bytes; if the phase is already there, the larger values are
+        kept.
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        if self._frames:
+            self._frames[-1][1] = max(self._frames[-1][1], peak)
+        tracemalloc.reset_peak()
+        self._frames.append([current, current, _maxrss()])
+        try:
+            yield
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            start, top, rss = self._frames.pop()
+            top = max(top, peak)
+            if self._frames:
+                self._frames[-1][1] = max(self._frames[-1][1], top)
+            tracemalloc.reset_peak()
+            old = usage.get(phase, (0, 0))
+            usage[phase] = [max(old[0], top - start),
+                            max(old[1], _maxrss() - rss)]
+
+def top_documents(usage, count):
+    "the `count` documents in usage with the highest traced peaks"
+    def key(item):
+        return max(peak for peak, _ in item[1].values())
+    return sorted(usage.items(), key=key, reverse=True)[:count]
+
+def format_report(usage, count):
+    "return the lines of a table with the top `count` documents"
+    def mib(n):
+        return '%.1f' % (n / 1048576.0)
+
+    lines = ['%-40s %9s %9s %9s %9s' % (('document',) + PHASES + ('RSS +',)),
+             '%-40s %9s %9s %9s %9s' % ('', 'MiB', 'MiB', 'MiB', 'MiB')]
+    for docname, phases in top_documents(usage, count):
+        peaks = [mib(phases[phase][0]) if phase in phases else '-'
+                 for phase in PHASES]
+        # parsing is part of the conversion
+        rss = sum(growth for phase, (_, growth) in phases.items()
+                  if phase != 'parse')
+        lines.append('%-40s %9s %9s %9s %9s'
+                     % tuple([docname] + peaks + [mib(rss)]))
+    return lines
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+    Profiling the DocBook converter
+    ===============================
+    A HandlerProfile records, for each e_tag() method of a
+    DocbookConverter (and for ``concat``, which converts the elements
+    that have no method), the number of calls, the time spent in the
+    method itself and in total, and the number of docutils nodes it
+    created.  It is saved as JSON, together with the self time of each
+    stack of handlers in the "collapsed" format read by flamegraph.pl
+    and speedscope.
+
+    The times of an element include converting its children and running
+    its deferred functions.  With the stream setting, the elements that
+    are converted one child at a time also include parsing their XML.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import json
+import os
+import time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+class HandlerProfile(object):
+    '''
+    Statistics for the handlers of any number of converters, usually
+    those of all the documents converted with the same settings.
+    '''
+
+    def __init__(self):
+        self.documents = 0
+        # name -> [calls, self time, cumulative time, self nodes,
+        #          cumulative nodes]
+        self.handlers = {}
+        # 'e_book;e_chapter;e_para' -> self time
+        self.stacks = {}
+        # nodes created so far
+        self.nodes = 0
+        # [name, stack, start, time in children, nodes at start,
+        #  nodes created by children]
+        self._frames = []
+        # name -> number of frames for it; cumulative figures are only
+        # counted for the outermost one
+        self._active = {}
+
+    def instrument(self, converter):
+        "count the nodes that converter creates with text() and create_node()"
+        text = converter.text
+        create_node = converter.create_node
+
+        def counting_text(string):
+            self.nodes += 1
+            return text(string)
+
+        def counting_create_node(*args, **kwargs):
+            self.nodes += 1
+            return create_node(*args, **kwargs)
+
+        converter.text = counting_text
+        converter.create_node = counting_create_node
+
+    def enter(self, tag, method):
+        "called when the converter starts an element handled by method"
+        if method is None:
+            name = 'concat'
+        elif tag.startswith('{'):
+            # an element in one of the converter's _NSMAP namespaces
+            name = method.__name__
+        else:
+            # not method.__name__, which is wrong for aliases like e_book
+            name = 'e_' + tag
+        stack = self._frames[-1][1] + ';' + name if self._frames else name
+        self._active[name] = self._active.get(name, 0) + 1
+        self._frames.append([name, stack, _clock(), 0.0, self.nodes, 0])
+
+    def exit(self):
+        "called when the converter is done with the innermost element"
+        end = _clock()
+        name, stack, start, child_time, nodes, child_nodes = self._frames.pop()
+        elapsed = end - start
+        created = self.nodes - nodes
+        self._active[name] -= 1
+
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = [0, 0.0, 0.0, 0, 0]
+        stats[0] += 1
+        stats[1] += elapsed - child_time
+        stats[3] += created - child_nodes
+        if not self._active[name]:
+            stats[2] += elapsed
+            stats[4] += created
+        self.stacks[stack] = self.stacks.get(stack, 0.0) + elapsed - child_time
+
+        if self._frames:
+            parent = self._frames[-1]
+            parent[3] += elapsed
+            parent[5] += created
+
+    def finish_document(self):
+        self.documents += 1
+        # left behind if the conversion failed
+        del self._frames[:]
+        self._active.clear()
+
+    def merge(self, other):
+        "add the statistics of other, for example from another process"
+        self.documents += other.documents
+        for name, stats in other.handlers.items():
+            mine = self.handlers.get(name)
+            if mine is None:
+                self.handlers[name] = list(stats)
+            else:
+                self.handlers[name] = [a + b for a, b in zip(mine, stats)]
+        for stack, seconds in other.stacks.items():
+            self.stacks[stack] = self.stacks.get(stack, 0.0) + seconds
+
+    def as_dict(self):
+        handlers = []
+        for name, stats in self.handlers.items():
+            calls, self_time, cumulative, self_nodes, nodes = stats
+            handlers.append({'handler': name, 'calls': calls,
+                             'self_seconds': self_time,
+                             'cumulative_seconds': cumulative,
+                             'self_nodes': self_nodes, 'nodes': nodes})
+        handlers.sort(key=lambda x: x['self_seconds'], reverse=True)
+        return {'documents': self.documents,
+                'seconds': sum(x['self_seconds'] for x in handlers),
+                'nodes': sum(x['self_nodes'] for x in handlers),
+                'handlers': handlers}
+
+    def collapsed_stacks(self):
+        "one line per stack, with its self time in microseconds"
+        return ''.join('%s %d\n' % (stack, round(seconds * 1e6))
+                       for stack, seconds in sorted(self.stacks.items()))
+
+    def save(self, path):
+        """
+        Write the JSON statistics to path, and the collapsed stacks to
+        the same file name with a .folded extension.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+            f.write('\n')
+        with open(os.path.splitext(path)[0] + '.folded', 'w') as f:
+            f.write(self.collapsed_stacks())
@@ -1,31 +1,105 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from docutils.core import publish_cmdline, default_description
-from db4sphinx.dbparser import DocbookParser
+import sys
+
+def publish_cmdline(reader=None, writer=None, writer_name='pseudoxml',
+                    description=None, suffix=None):
+    # docutils and lxml are only imported by the commands that use them
+    from db4sphinx import cmdline
+    cmdline.publish_cmdline(reader, writer, writer_name,
+                            description or cmdline.default_description, suffix)
 
 def db2html():
+    from docutils.core import default_description
     description = ('Generates (X)HTML documents from standalone DocBook '
                    'sources.  ' + default_description)
 
-    publish_cmdline(parser=DocbookParser(), writer_name='html', description=description)
+    publish_cmdline(writer_name='html', description=description)
 
 def db2odt():
+    from docutils.core import default_description
     from docutils.writers import odf_odt
     description = ('Generates ODT documents from standalone DocBook '
                    'sources.  ' + default_description)
 
-    publish_cmdline(parser=DocbookParser(), reader=odf_odt.Reader(), writer=odf_odt.Writer(), description=description)
+    publish_cmdline(reader=odf_odt.Reader(), writer=odf_odt.Writer(),
+                    description=description, suffix='.odt')
 
 def db2pseudoxml():
+    from docutils.core import default_description
     description = ('Generates pseudo XML documents from standalone DocBook '
                    'sources.  ' + default_description)
 
-    publish_cmdline(parser=DocbookParser(), writer_name='pseudoxml', description=description)
+    publish_cmdline(writer_name='pseudoxml', description=description)
 
 def db2xml():
+    from docutils.core import default_description
     description = ('Generates XML documents from standalone DocBook '
                    'sources.  ' + default_description)
 
-    publish_cmdline(parser=DocbookParser(), writer_name='xml', description=description)
+    publish_cmdline(writer_name='xml', description=description)
+
+def db2assembly():
+    import argparse
+    from db4sphinx.chunker import AssemblyChunker
+
+    parser = argparse.ArgumentParser(
+        description='Splits a DocBook book into topics and an assembly '
+                    'that can be read by the db4sphinx Sphinx extension.  '
+                    'Topics that did not change are not rewritten.')
+    parser.add_argument('source', nargs='?', default='-',
+                        help='DocBook file to split (default: stdin)')
+    parser.add_argument('--base-dir', default='topics/',
+                        help='directory for the topic files (default: topics/)')
+    parser.add_argument('--assembly-filename', default='index.xml',
+                        help='name of the assembly file (default: index.xml)')
+    parser.add_argument('--chunk-section-depth', type=int, default=1,
+                        help='split sections up to this depth (default: 1)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of files written in parallel '
+                             '(default: number of CPUs)')
+    parser.add_argument('--no-xinclude', action='store_false', dest='xinclude',
+                        help='do not process XIncludes')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, and split the book again when '
+                             'it or the files that it includes change')
+    parser.add_argument('--watch-poll', action='store_true',
+                        help='with --watch, check the files every second '
+                             'instead of using inotify')
+    args = parser.parse_args()
+
+    source = args.source
+    if source == '-':
+        if args.watch:
+            parser.error('--watch requires a source file')
+        source = getattr(sys.stdin, 'buffer', sys.stdin)
+    chunker = AssemblyChunker(base_dir=args.base_dir,
+                              assembly_filename=args.assembly_filename,
+                              section_depth=args.chunk_section_depth,
+                              jobs=args.jobs, xinclude=args.xinclude)
+    if not args.watch:
+        written, unchanged = chunker.chunk(source)
+        sys.stderr.write('%d files written, %d unchanged\n' % (written, unchanged))
+        return
 
+    from db4sphinx.watch import Watcher
+    watcher = Watcher(polling=args.watch_poll)
+    watcher.set_dependencies(source, [source])
+    try:
+        while True:
+            try:
+                written, unchanged = chunker.chunk(source)
+                sys.stderr.write('%d files written, %d unchanged\n'
+                                 % (written, unchanged))
+            except Exception as e:
+                # the book is probably being edited, try again later
+                sys.stderr.write('%s: error: %s\n' % (source, e))
+            watcher.set_dependencies(source, [source] + list(chunker.dependencies))
+            sys.stderr.write('Watching for changes%s, press Ctrl-C to stop.\n'
+                             % (' (polling)' if watcher.polling else ''))
+            watcher.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
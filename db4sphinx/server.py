@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+    Conversion server for editor previews
+    =====================================
+    A long-running process that listens on a Unix socket and converts
+    DocBook documents on request.  The converter, the parsed XIncludes
+    and the output for unchanged inputs stay in memory between requests,
+    so a preview does not pay for interpreter startup and imports.
+
+    Each request and each reply is a JSON object on a single line.  A
+    request has these keys:
+
+    ``path``
+        the DocBook file; relative XIncludes are resolved against it
+    ``source``
+        optional; the content of an unsaved buffer, used instead of
+        reading ``path``
+    ``source_base64``
+        optional; the same as ``source``, but for the undecoded bytes of
+        the buffer, so that the encoding in the XML declaration is used
+    ``writer``
+        optional; ``html`` (the default), ``pseudoxml`` or ``xml``
+
+    The reply has an ``output`` string, a ``messages`` string with the
+    warnings and errors, an integer ``status`` and a ``cached`` flag.
+    Malformed requests get a reply with an ``error`` key instead.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import socket
+import sys
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+WRITERS = ('html', 'pseudoxml', 'xml')
+
+def default_socket_path():
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if directory:
+        return os.path.join(directory, 'db4sphinx.sock')
+    return '/tmp/db4sphinx-%d.sock' % os.getuid()
+
+class Converter(object):
+    '''
+    Converts documents with docutils, and remembers the output for the
+    last `max_entries` documents.  An entry is reused as long as the
+    source is the same and none of the files it includes has changed.
+    '''
+
+    def __init__(self, max_entries=64):
+        from collections import OrderedDict
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._defaults = {}
+
+    def _settings(self, writer_name):
+        # building the option parser is expensive, do it once per writer
+        import copy
+        import warnings
+        from docutils.frontend import OptionParser
+        from docutils.readers import get_reader_class
+        from docutils.writers import get_writer_class
+        from db4sphinx.dbparser import DocbookParser
+
+        try:
+            defaults = self._defaults[writer_name]
+        except KeyError:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                option_parser = OptionParser(components=(
+                    DocbookParser, get_reader_class('standalone'),
+                    get_writer_class(writer_name)))
+            defaults = option_parser.get_default_values()
+            defaults.output_encoding = 'utf-8'
+            defaults.halt_level = 5
+            # let exceptions through instead of exiting the server
+            defaults.traceback = True
+            self._defaults[writer_name] = defaults
+        return copy.copy(defaults)
+
+    def convert(self, path, source=None, writer_name='html'):
+        "return a dictionary with the reply to a request"
+        from docutils.core import publish_programmatically
+        from docutils.io import StringOutput
+        from docutils.utils import DependencyList
+        from db4sphinx.dbparser import DocbookParser, DocbookStringInput
+
+        # bytes are decoded by lxml, strings are used as they are
+        if source is None:
+            with open(path, 'rb') as f:
+                source = f.read()
+        raw = isinstance(source, bytes)
+        key = (writer_name, os.path.abspath(path))
+        digest = (raw, hashlib.sha1(source if raw
+                                    else source.encode('utf-8')).hexdigest())
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == digest and _valid(entry[1]):
+            self._entries.pop(key)
+            self._entries[key] = entry
+            return dict(entry[2], cached=True)
+
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        settings = self._settings(writer_name)
+        settings.warning_stream = messages = StringIO()
+        settings.record_dependencies = dependencies = DependencyList()
+        status = 0
+        try:
+            output, _ = publish_programmatically(
+                source_class=DocbookStringInput, source=source,
+                source_path=path, destination_class=StringOutput,
+                destination=None, destination_path=None,
+                reader=None, reader_name='standalone',
+                parser=DocbookParser(), parser_name=None,
+                writer=None, writer_name=writer_name,
+                settings=settings, settings_spec=None,
+                settings_overrides=None, config_section=None,
+                enable_exit_status=False)
+            output = output.decode('utf-8')
+        except Exception as e:
+            messages.write('%s: %s\n' % (e.__class__.__name__, e))
+            output = ''
+            status = 1
+
+        reply = {'output': output, 'messages': messages.getvalue(),
+                 'status': status}
+        if status == 0:
+            self._entries.pop(key, None)
+            self._entries[key] = (digest, _mtimes(dependencies.list), reply)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return dict(reply, cached=False)
+
+def _mtimes(paths):
+    result = []
+    for path in paths:
+        try:
+            result.append((path, os.stat(path).st_mtime))
+        except EnvironmentError:
+            result.append((path, None))
+    return result
+
+def _valid(mtimes):
+    for path, mtime in mtimes:
+        try:
+            if os.stat(path).st_mtime != mtime:
+                return False
+        except EnvironmentError:
+            if mtime is not None:
+                return False
+    return True
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                writer_name = request.get('writer', 'html')
+                if writer_name not in WRITERS:
+                    raise ValueError('unknown writer %r' % writer_name)
+                source = request.get('source')
+                if 'source_base64' in request:
+                    source = base64.b64decode(
+                        request['source_base64'].encode('ascii'))
+                reply = self.server.converter.convert(request['path'], source,
+                                                      writer_name)
+            except (ValueError, KeyError, TypeError, EnvironmentError) as e:
+                reply = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class ConversionServer(socketserver.UnixStreamServer):
+    '''
+    Serves one connection at a time; a connection can send any number
+    of requests.
+    '''
+
+    def __init__(self, socket_path, converter):
+        self.converter = converter
+        _remove_stale_socket(socket_path)
+        # only the user who started the server may connect
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path,
+                                                   RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except EnvironmentError:
+            pass
+
+def _remove_stale_socket(socket_path):
+    if not os.path.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        os.unlink(socket_path)
+        return
+    finally:
+        sock.close()
+    raise EnvironmentError('a server is already listening on %s' % socket_path)
+
+def request(socket_path, path, source=None, writer_name='html'):
+    "send one request to the server at socket_path and return its reply"
+    message = {'path': path, 'writer': writer_name}
+    if isinstance(source, bytes):
+        message['source_base64'] = base64.b64encode(source).decode('ascii')
+    elif source is not None:
+        message['source'] = source
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        f = sock.makefile('rb')
+        try:
+            return json.loads(f.readline().decode('utf-8'))
+        finally:
+            f.close()
+    finally:
+        sock.close()
+
+def serve(socket_path=None, max_entries=64):
+    import signal
+    # warm up the imports before accepting requests
+    import docutils.core
+    import db4sphinx.dbparser
+
+    server = ConversionServer(socket_path or default_socket_path(),
+                              Converter(max_entries))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Keeps a DocBook converter running, and converts '
+                    'documents sent to it by python-db4sphinx-preview.')
+    parser.add_argument('--socket', default=default_socket_path(),
+                        help='Unix socket to listen on (default: %(default)s)')
+    parser.add_argument('--cache-entries', type=int, default=64,
+                        help='number of converted documents kept in memory '
+                             '(default: 64)')
+    args = parser.parse_args()
+    try:
+        serve(args.socket, args.cache_entries)
+    except EnvironmentError as e:
+        parser.exit(1, '%s: error: %s\n' % (parser.prog, e))
+
+def preview():
+    # this runs for every preview, so it only imports the standard library
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Converts a DocBook document with a running '
+                    'python-db4sphinx-server and writes it to stdout.')
+    parser.add_argument('source',
+                        help='DocBook file; with --stdin, the name used for '
+                             'resolving XIncludes and in messages')
+    parser.add_argument('--stdin', action='store_true',
+                        help='read the document from stdin, e.g. an editor '
+                             'buffer that has not been saved')
+    parser.add_argument('--writer', choices=WRITERS, default='html',
+                        help='output format (default: html)')
+    parser.add_argument('--socket', default=default_socket_path(),
+                        help='Unix socket of the server '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    source = None
+    if args.stdin:
+        source = getattr(sys.stdin, 'buffer', sys.stdin).read()
+    try:
+        reply = request(args.socket, os.path.abspath(args.source), source,
+                        args.writer)
+    except (socket.error, ValueError) as e:
+        parser.exit(2, '%s: cannot reach the server at %s: %s\n'
+                    % (parser.prog, args.socket, e))
+    if 'error' in reply:
+        parser.exit(2, '%s: error: %s\n' % (parser.prog, reply['error']))
+
+    sys.stderr.write(reply['messages'])
+    output = reply['output'].encode('utf-8')
+    getattr(sys.stdout, 'buffer', sys.stdout).write(output)
+    sys.exit(reply['status'])
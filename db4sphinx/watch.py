@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+    Watching input files for changes
+    ================================
+    A Watcher knows which files each output was built from, and reports
+    the outputs that are affected when some of those files change.  On
+    Linux it sleeps on inotify; elsewhere, or when inotify is not
+    available (as in some containers), it polls.  Either way, the files
+    are compared with os.stat, so editors that save by renaming a new
+    file over the old one are handled too.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import os
+import select
+import sys
+import time
+
+class _Inotify(object):
+    "wait for changes in a set of directories, using Linux inotify"
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+    # IN_MOVED_TO | IN_CREATE | IN_DELETE
+    MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init1(self.IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._directories = set()
+
+    def add(self, directory):
+        if directory in self._directories:
+            return
+        self._directories.add(directory)
+        if not isinstance(directory, bytes):
+            directory = directory.encode(sys.getfilesystemencoding())
+        # a failure only means that changes are noticed at the next timeout
+        self._libc.inotify_add_watch(self._fd, directory, self.MASK)
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return False
+        # the events themselves are not needed, the files are stat'ed
+        os.read(self._fd, 65536)
+        return True
+
+    def close(self):
+        os.close(self._fd)
+
+class _Poller(object):
+    "wait for a fixed interval"
+
+    def add(self, directory):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return True
+
+    def close(self):
+        pass
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+    except EnvironmentError:
+        return None
+    return st.st_mtime, st.st_size
+
+class Watcher(object):
+    '''
+    Maps each target (any hashable object, for example a pair of source
+    and destination) to the files it depends on.  wait() blocks until
+    some of these files change, and returns the affected targets.
+    '''
+
+    def __init__(self, interval=1.0, polling=False):
+        self.interval = interval
+        self._backend = None
+        if not polling:
+            try:
+                self._backend = _Inotify()
+            except (OSError, AttributeError):
+                pass
+        if self._backend is None:
+            self._backend = _Poller()
+        self._dependencies = {}     # target -> set of paths
+        self._signatures = {}       # path -> (mtime, size) or None
+
+    @property
+    def polling(self):
+        return isinstance(self._backend, _Poller)
+
+    def set_dependencies(self, target, paths):
+        """
+        Record that target was built from paths.  The state of the files
+        that were already being watched is left alone, so that changes
+        done while target was being built are noticed by the next wait().
+        """
+        paths = set(os.path.abspath(p) for p in paths)
+        self._dependencies[target] = paths
+        for path in paths:
+            if path not in self._signatures:
+                self._signatures[path] = _signature(path)
+                self._backend.add(os.path.dirname(path))
+
+    def changed_files(self):
+        "return the dependencies that changed, and record their new state"
+        changed = set()
+        for path, signature in self._signatures.items():
+            new = _signature(path)
+            if new != signature:
+                changed.add(path)
+                self._signatures[path] = new
+        return changed
+
+    def wait(self, delay=0.1):
+        """
+        Wait until some dependencies change, and return the list of
+        targets that depend on them.  delay gives editors and tools
+        time to finish writing the files.
+        """
+        while True:
+            if self._backend.wait(self.interval):
+                time.sleep(delay)
+            changed = self.changed_files()
+            targets = [target for target, paths in self._dependencies.items()
+                       if not paths.isdisjoint(changed)]
+            if targets:
+                return targets
+
+    def close(self):
+        self._backend.close()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+    XInclude processing for the DocBook parser
+    ==========================================
+    Included files are parsed once and kept in a FragmentCache, so that
+    boilerplate shared by many documents (legal notices, procedures,
+    entity files) is not parsed again for every document that includes it.
+
+    :copyright: 2016 Paolo Bonzini
+    :license: MIT.
+"""
+
+import copy
+import io
+import os
+import re
+
+XI_NS = '{http://www.w3.org/2001/XInclude}'
+XI_INCLUDE = XI_NS + 'include'
+XI_FALLBACK = XI_NS + 'fallback'
+
+_XPOINTER_ID = re.compile(r"""^(?:element\((\w[\w.-]*)\)|xpointer\(id\(['"]([^'"]*)['"]\)\))$""")
+
+class XIncludeError(Exception):
+    pass
+
+class FragmentCache(object):
+    '''
+    Included files, parsed and with their own XIncludes resolved.  An
+    entry is reused as long as none of the files it was built from has
+    changed its modification time.
+    '''
+
+    def __init__(self):
+        self._entries = {}
+        self._loading = set()
+
+    def get(self, path, parse, encoding, load_xml, resolver):
+        '''
+        Return a tuple (content, dependencies) for path.  content is an
+        element for parse="xml" and a string for parse="text";
+        dependencies is a list of (path, mtime) tuples.
+        '''
+        key = (path, parse, encoding)
+        entry = self._entries.get(key)
+        if entry is not None and self._valid(entry[1]):
+            return entry
+
+        if key in self._loading:
+            raise XIncludeError('recursive XInclude of %s' % path)
+        self._loading.add(key)
+        try:
+            deps = [(path, os.stat(path).st_mtime)]
+            if parse == 'text':
+                with io.open(path, encoding=encoding or 'utf-8') as f:
+                    content = f.read()
+            else:
+                content = load_xml(path)
+                deps.extend(resolver.resolve(content))
+        finally:
+            self._loading.discard(key)
+
+        entry = (content, deps)
+        self._entries[key] = entry
+        return entry
+
+    def _valid(self, deps):
+        try:
+            for path, mtime in deps:
+                if os.stat(path).st_mtime != mtime:
+                    return False
+        except EnvironmentError:
+            return False
+        return True
+
+    def clear(self):
+        self._entries.clear()
+
+class XIncludeResolver(object):
+    '''
+    Replaces xi:include elements with the content they point to.
+    load_xml(path) parses an XML file and returns its root element.
+    '''
+
+    def __init__(self, cache, load_xml, reporter=None):
+        self.cache = cache
+        self.load_xml = load_xml
+        self.reporter = reporter
+
+    def resolve(self, el):
+        '''
+        Resolve the XIncludes in the subtree rooted at el, including el
+        itself.  Return a list of (path, mtime) tuples for all the files
+        that were included.
+        '''
+        deps = []
+        if el.tag == XI_INCLUDE:
+            includes = [el]
+        else:
+            includes = [x for x in el.iter(XI_INCLUDE) if not _nested(x, el)]
+        for include in includes:
+            self._include(include, deps)
+        return deps
+
+    def _include(self, include, deps):
+        href = include.get('href')
+        parse = include.get('parse', 'xml')
+        try:
+            if not href or '://' in href or include.getparent() is None:
+                raise XIncludeError('cannot include %r' % href)
+            base = include.base
+            if base:
+                href = os.path.join(os.path.dirname(base), href)
+            path = os.path.abspath(href)
+            content, new_deps = self.cache.get(path, parse,
+                                               include.get('encoding'),
+                                               self.load_xml, self)
+            if parse != 'text':
+                content = self._select(content, include.get('xpointer'))
+        except (XIncludeError, EnvironmentError, SyntaxError) as e:
+            fallback = include.find(XI_FALLBACK)
+            if fallback is None:
+                if self.reporter is not None:
+                    self.reporter.error(str(e), line=include.sourceline)
+                _replace(include, '', [])
+                return
+            # includes in the fallback were resolved already, if it
+            # comes from a fragment; otherwise, resolve them now
+            deps.extend(self.resolve(fallback))
+            _replace(include, fallback.text or '', list(fallback))
+            return
+
+        deps.extend(new_deps)
+        if parse == 'text':
+            _replace(include, content, [])
+        else:
+            # an element picked by xpointer keeps the text after it
+            content = copy.deepcopy(content)
+            content.tail = None
+            _replace(include, '', [content])
+
+    def _select(self, root, xpointer):
+        if not xpointer:
+            return root
+        match = _XPOINTER_ID.match(xpointer)
+        name = xpointer if match is None else (match.group(1) or match.group(2))
+        for el in root.iter():
+            if name in (el.get('{http://www.w3.org/XML/1998/namespace}id'),
+                        el.get('id')):
+                return el
+        raise XIncludeError('xpointer %s not found' % xpointer)
+
+def _nested(include, root):
+    "true if include is within another xi:include (e.g. in its fallback)"
+    parent = include.getparent()
+    while parent is not root:
+        if parent.tag == XI_INCLUDE:
+            return True
+        parent = parent.getparent()
+    return False
+
+def _replace(el, text, elements):
+    "replace el with text followed by elements, keeping its tail"
+    parent = el.getparent()
+    if elements:
+        elements[-1].tail = (elements[-1].tail or '') + (el.tail or '')
+    else:
+        text = text + (el.tail or '')
+
+    if text:
+        prev = el.getprevious()
+        if prev is not None:
+            prev.tail = (prev.tail or '') + text
+        else:
+            parent.text = (parent.text or '') + text
+
+    index = parent.index(el)
+    parent.remove(el)
+    for i, child in enumerate(elements):
+        parent.insert(index + i, child)
@@ -105,6 +105,9 @@ setup(
             'python-db2odt=db4sphinx.scripts:db2odt',
             'python-db2pseudoxml=db4sphinx.scripts:db2pseudoxml',
             'python-db2xml=db4sphinx.scripts:db2xml',
+            'python-db2assembly=db4sphinx.scripts:db2assembly',
+            'python-db4sphinx-server=db4sphinx.server:main',
+            'python-db4sphinx-preview=db4sphinx.server:preview',
         ],
     },
 )